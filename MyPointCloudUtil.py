@@ -12,48 +12,292 @@ import matplotlib.pyplot as plt
 #from mpl_toolkits.mplot3d import Axes3D
 import datetime
 import chardet
+import csv
+import hashlib
+import heapq
+import itertools
 import math
+import multiprocessing
+import numpy as np
 import os
+import plyfile
+import queue
 import sys
-import thread
+import tempfile
+
+# scipy is optional, without it the distance methods fall back to brute force
+try:
+    from scipy.spatial import ConvexHull, cKDTree
+    from scipy.spatial.distance import directed_hausdorff
+except ImportError:
+    ConvexHull = cKDTree = directed_hausdorff = None
+
+# a point cloud is a C-contiguous (N, 3) float array, one [x, y, z] row per point
+# it is a plain numpy subclass, so every numpy routine accepts it
+class PointCloud(np.ndarray):
+
+    def __new__(cls, data, dtype=np.float64):
+
+        # input: anything numpy can read as (N, 3), e.g. [[x,y,z],[x,y,z]...] or another array
+        # output: the point cloud, sharing memory with data when no conversion is needed
+
+        array = np.ascontiguousarray(data, dtype=dtype)
+        if array.size == 0:
+            array = array.reshape(0, 3)
+        if array.ndim != 2 or array.shape[1] != 3:
+            raise ValueError("point cloud must have shape (N, 3), got %s" % (array.shape,))
+        return array.view(cls)
 
 class MyPointCloudUtil(object):
 
+    # file extension -> loader, the name of one of the methods below or a function, see registerLoader
+    loaders = {".pts": "ptsloader1", ".ply": "plyloader", ".off": "offloader"}
+
+    # file extension -> method streaming it in chunks, see chunkloader
+    chunkloaders = {".pts": "ptschunkloader", ".ply": "plychunkloader", ".off": "offchunkloader"}
+
+    # dtype is the float type of every cloud this instance returns, np.float32 halves the memory
+    # cachedir is where load keeps a binary copy of every file it parses, None for no cache
+    def __init__(self, dtype=np.float64, cachedir=None):
+        self.dtype = np.dtype(dtype)
+        self.cachedir = cachedir
+        self.loaders = dict(MyPointCloudUtil.loaders)
+
+    # convert an array (list of [x,y,z] or numpy array) into a point cloud of this instance's dtype
+    def asPointCloud(self, array):
+
+        # input: array from ptsloader1 or any [[x,y,z],[x,y,z]...] like object
+        # output: PointCloud, the same object if it is already one with the right dtype
+
+        # a view of a PointCloud (transposed, sliced, strided) is still of that class, so check it is (N, 3)
+        if (isinstance(array, PointCloud) and array.dtype == self.dtype and array.ndim == 2
+                and array.shape[1] == 3 and array.flags["C_CONTIGUOUS"]):
+            return array
+        return PointCloud(array, self.dtype)
+
+    # methods that modify a cloud in place call this so list inputs keep being modified too
+    def _writeBack(self, array, cloud):
+
+        # input: the array the caller passed in, the point cloud built from it
+        # output: array holds the values of cloud
+
+        if cloud is array:
+            return
+        if isinstance(array, np.ndarray):
+            array[...] = cloud
+        else:
+            for coordinates, point in zip(array, cloud.tolist()):
+                coordinates[:] = point
+
     # load all the point cloud file under one or many dirctory
-    def batchloader(self, path):
+    def batchloader(self, path, workers=None):
+
+        #input: the dictory contains all point cloud file, number of worker processes
+        #       (None: one per cpu, 1: load in this process)
+        #output: dict from file name to its PointCloud, files without a registered loader are skipped
+
+        tasks = self._batchTasks(path)
+        if workers == 1 or len(tasks) <= 1:
+            return dict(_loadWorker(task) for task in tasks)
+
+        # cached files are mapped here, a worker could only send back a copy
+        clouds, tasks = self._loadCached(tasks)
+        if not tasks:
+            return clouds
+        pool = multiprocessing.Pool(workers)
+        try:
+            clouds.update(self._mapLoaded(result) for result in pool.imap_unordered(_loadWorker, tasks))
+            return clouds
+        finally:
+            pool.terminate()
+
+    # load all the point cloud file under one dirctory, one at a time, as they are needed
+    def iterbatchloader(self, path, workers=None, prefetch=None):
+
+        #input: the dictory contains all point cloud file, number of worker processes
+        #       (None: one per cpu, 1: load in this process), number of files loaded ahead of the consumer
+        #       (None: one per worker)
+        #output: generator of (file name, PointCloud) in the order the files finish loading,
+        #        at most prefetch clouds are held besides the one being consumed
+
+        tasks = self._batchTasks(path)
+        if workers == 1:
+            for task in tasks:
+                yield _loadWorker(task)
+            return
+
+        clouds, tasks = self._loadCached(tasks)
+        for name in sorted(clouds):
+            yield name, clouds.pop(name)
+        if not tasks:
+            return
+
+        pool = multiprocessing.Pool(workers)
+        if prefetch is None:
+            prefetch = workers or multiprocessing.cpu_count()
+        prefetch = max(prefetch, 1)
+        done = queue.Queue()
+        pending = 0
+        try:
+            for task in tasks:
+                # wait for the consumer before starting more than prefetch files
+                if pending == prefetch:
+                    yield self._nextLoaded(done)
+                    pending -= 1
+                pool.apply_async(_loadWorker, (task,), callback=done.put, error_callback=done.put)
+                pending += 1
+            for i in range(pending):
+                yield self._nextLoaded(done)
+        finally:
+            pool.terminate()
+
+    # wait for the next file finished by iterbatchloader's pool
+    def _nextLoaded(self, done):
+
+        #input: the queue the pool callbacks put results and errors in
+        #output: (file name, PointCloud), errors of the worker are raised here
+
+        result = done.get()
+        if isinstance(result, BaseException):
+            raise result
+        return self._mapLoaded(result)
+
+    # load the files of a batch that are already in the cache
+    def _loadCached(self, tasks):
+
+        #input: list of _loadWorker tasks
+        #output: dict from file name to the mapped PointCloud of the cached files, the tasks left to load
+
+        clouds = {}
+        if not self.cachedir:
+            return clouds, tasks
+        misses = []
+        for task in tasks:
+            util, path, name = task
+            if os.path.exists(self._cachePath(path)):
+                clouds[name] = self.load(path)
+            else:
+                misses.append(task)
+        return clouds, misses
+
+    # turn a result of a _loadWorker process into the cloud
+    def _mapLoaded(self, result):
+
+        #input: (file name, PointCloud or the path of the cache file the worker wrote)
+        #output: (file name, PointCloud), memory mapped from the cache if there is one
+
+        name, cloud = result
+        if isinstance(cloud, str):
+            cloud = self.asPointCloud(np.load(cloud, mmap_mode="c"))
+        return name, cloud
+
+    # the files batchloader and iterbatchloader load from a directory
+    def _batchTasks(self, path):
 
         #input: the dictory contains all point cloud file
-        #output: the 3 dimension array contains all point clouds
-
-        allfiles = 	os.listdir(path)
-        if not (path.endswith("/") or path.endswith("\\")): # linux:\ windows:/
-            path = path + os.sep
-        allPointClouds = []
-        pointcloud = []
-        for file in allfiles:
-            if file.endswith(".pts"):
-                pointcloud = self.ptsloader1(path+file)
-            elif file.endswith(".ply"):
-                pointcloud = self.plyloader(path+file)
-            elif file.endswith(".off"):
-                pointcloud = self.offloader(path+file)
-            allPointClouds.append(pointcloud)
-            pointcloud = []
-        return  allPointClouds
+        #output: list of _loadWorker tasks, one per file with a registered loader
+
+        return [(self, os.path.join(path, file), file) for file in sorted(os.listdir(path))
+                if self.getLoader(file) is not None]
+
+    # register the loader used for files with the given extension
+    def registerLoader(self, extension, loader):
+
+        #input: extension like ".xyz", the name of a method of this class or a function taking the file path
+        #       and returning the points (must be a module level function to work with batchloader's processes)
+        #output: none, later loads of such files go through loader
+
+        self.loaders[extension.lower()] = loader
+
+    # find the loader registered for a file
+    def getLoader(self, path):
+
+        #input: file path or name
+        #output: the loader as a callable, None if its extension has no loader
+
+        loader = self.loaders.get(os.path.splitext(path)[1].lower())
+        if isinstance(loader, str):
+            loader = getattr(self, loader)
+        return loader
+
+    # load one file with the loader registered for its extension
+    def load(self, path, cache=True):
+
+        #input: point cloud file path, whether to use the cache in self.cachedir (if set)
+        #output: PointCloud of shape (N, 3)
+
+        loader = self.getLoader(path)
+        if loader is None:
+            raise ValueError("%s: no loader registered for this file type" % path)
+        if not (cache and self.cachedir):
+            return self.asPointCloud(loader(path))
+
+        cachepath = self._cachePath(path)
+        if os.path.exists(cachepath):
+            # copy-on-write map: nothing is read until used and changes never reach the cache
+            return self.asPointCloud(np.load(cachepath, mmap_mode="c"))
+
+        cloud = self.asPointCloud(loader(path))
+        self._writeCache(cachepath, cloud)
+        return cloud
+
+    # name of the cache file of a point cloud file
+    def _cachePath(self, path):
+
+        #input: point cloud file path
+        #output: path of its .npy file in self.cachedir
+
+        # the name holds the source's size and modification time and the dtype, so editing or
+        # replacing the source (or loading with another dtype) never matches an old cache file
+        stat = os.stat(path)
+        key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cachedir, "%s-%d-%d-%s.npy" % (key, stat.st_size, stat.st_mtime_ns, self.dtype.name))
+
+    # store a parsed point cloud in the cache, replacing the stale copies of the same source
+    def _writeCache(self, cachepath, cloud):
+
+        #input: path from _cachePath, the PointCloud
+        #output: none, the cache file is written
+
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        # same source with another size or modification time is stale, other dtypes of this version are kept
+        key, size, mtime = os.path.basename(cachepath).split("-")[:3]
+        current = "-".join((key, size, mtime)) + "-"
+        for file in os.listdir(self.cachedir):
+            if file.startswith(key + "-") and not file.startswith(current) and file.endswith(".npy"):
+                os.remove(os.path.join(self.cachedir, file))
+
+        # write under a temporary name and rename, so a concurrent reader never sees half a file
+        handle, temppath = tempfile.mkstemp(suffix=".tmp", dir=self.cachedir)
+        with os.fdopen(handle, "wb") as cachefile:
+            np.save(cachefile, np.asarray(cloud))
+        os.replace(temppath, cachepath)
 
     # load file in pts format
-    def ptsloader1(self, path):
+    def ptsloader1(self, path, blocksize=1 << 24):
 
-        #input: pts file path
-        #output: 2D array in format like [[x,y,z],[x,y,z]...]
+        #input: pts file path, number of bytes parsed at a time
+        #output: PointCloud of shape (N, 3), rows like [[x,y,z],[x,y,z]...]
 
-        rows = []
-        ptsfile = open(path)
-        for row in ptsfile:
-            # strip remove /r/n at the end of a row; split dived them into array
-            coordinates = [float(x) for x in row.strip().split(" ")]
-            rows.append(coordinates)
-        return rows
+        # count the rows first so the output is allocated once and filled block by block,
+        # peak memory is the output plus one block of text
+        count = 0
+        lastbyte = b"\n"
+        with open(path, "rb") as ptsfile:
+            for block in iter(lambda: ptsfile.read(blocksize), b""):
+                count += block.count(b"\n")
+                lastbyte = block[-1:]
+        if lastbyte != b"\n":
+            count += 1
+
+        # header and blank rows make count an upper bound, the unused tail is cut off at the end
+        rows = np.empty((count, 3), dtype=self.dtype)
+        filled = 0
+        for coordinates in self._readPtsBlocks(path, blocksize):
+            rows[filled:filled+len(coordinates)] = coordinates
+            filled += len(coordinates)
+        return self.asPointCloud(rows[:filled])
 
     # load file in pts format
     def ptsloader2(self, path):
@@ -61,101 +305,456 @@ class MyPointCloudUtil(object):
         # input: pts file path
         # output: X Y Z array
 
-        X = []
-        Y = []
-        Z = []
-        ptsfile = open(path)
-        for row in ptsfile:
-            # strip remove /r/n at the end of a row; split dived them into array
-            coordinates = [float(x) for x in row.strip().split(" ")]
-            X.append(coordinates[0])
-            Y.append(coordinates[1])
-            Z.append(coordinates[2])
-        return X, Y, Z
+        return self.extractXYZ(self.ptsloader1(path))
+
+    # parse a pts file a block of whole rows at a time
+    def _readPtsBlocks(self, path, blocksize=1 << 24):
+
+        # input: pts file path, number of bytes parsed at a time
+        # output: generator of float64 arrays of shape (M, 3), the x y z of the rows in each block
+
+        with open(path, "rb") as ptsfile:
+            columns = 0
+            rest = b""
+            while True:
+                block = ptsfile.read(blocksize)
+                if block:
+                    # keep the unfinished last row for the next block
+                    block = rest + block
+                    cut = block.rfind(b"\n") + 1
+                    block, rest = block[:cut], block[cut:]
+                elif rest:
+                    # end of file, the last row has no line end
+                    block, rest = rest, b""
+                else:
+                    break
+                if columns == 0:
+                    columns, block = self._ptsColumns(block)
+                    if columns == 0:
+                        continue
+                # np.fromstring treats any run of spaces, tabs and line ends as one separator
+                values = np.fromstring(block, dtype=np.float64, sep=" ")
+                counts = self._ptsFieldCounts(block)
+                if len(values) != counts.sum() or not (counts == columns).all():
+                    raise ValueError("%s: rows do not all have %d columns" % (path, columns))
+                # trailing columns (intensity, r g b ...) are dropped, only x y z are kept
+                yield values.reshape(-1, columns)[:, :3]
+
+    # number of values on each row with data in a block of a pts file
+    def _ptsFieldCounts(self, block):
+
+        # input: a block of whole rows
+        # output: array of the number of values of every row that is not blank
+
+        data = np.frombuffer(block, dtype=np.uint8)
+        # spaces, tabs, line ends and other control characters separate the values
+        separator = data <= ord(" ")
+        # a value starts where a separator (or the block start) is followed by something else
+        starts = ~separator
+        starts[1:] &= separator[:-1]
+        bounds = np.concatenate(([0], np.flatnonzero(data == ord("\n")), [len(data)]))
+        counts = np.diff(np.searchsorted(np.flatnonzero(starts), bounds))
+        return counts[counts > 0]
+
+    # find the number of columns of a pts file from the first rows of data
+    def _ptsColumns(self, block):
+
+        # input: the first block of a pts file
+        # output: number of columns (0 if the block has no data row yet), the block without header rows
+
+        start = 0
+        while start < len(block):
+            end = block.find(b"\n", start)
+            if end == -1:
+                end = len(block)
+            fields = block[start:end].split()
+            # rows with less than 3 values are header rows, e.g. the point count some scanners write
+            if len(fields) >= 3:
+                return len(fields), block[start:]
+            start = end + 1
+        return 0, b""
 
     # load file in ply format
     def plyloader(self,path):
 
         # input: ply file path
-        # output: X Y Z array
+        # output: PointCloud of shape (N, 3), the x y z of the vertex element
+
+        # binary files are read by plyfile, which memory maps elements without list properties,
+        # so a float vertex element holding only x y z comes back without any copy
+        with open(path, "rb") as plystream:
+            plydata, element = self._readPlyHeader(plystream, path)
+            if plydata.text and not element._have_list:
+                rows = self._readPlyAsciiVertices(plystream, element, element.count)
+                return self.asPointCloud(rows)
+            element._read(plystream, plydata.text, plydata.byte_order)
+        return self.asPointCloud(self._plyXYZView(element.data))
+
+    # read a ply file up to its vertex element
+    def _readPlyHeader(self, plystream, path):
+
+        # input: ply file opened in binary mode, its path for error messages
+        # output: PlyData with the header, the vertex PlyElement; plystream is left on the first vertex
+
+        plydata = plyfile.PlyData._parse_header(plystream)
+        for element in plydata:
+            if element.name == "vertex":
+                return plydata, element
+            # skip the elements stored before the vertices
+            if plydata.text:
+                for i in range(element.count):
+                    plystream.readline()
+            else:
+                element._read(plystream, plydata.text, plydata.byte_order)
+        raise plyfile.PlyParseError("%s: no vertex element" % path)
 
-        # plyfile = open(path, "rb")
-        # buf = plyfile.readline()
-        #print(chardet.detect(buf))
+    # parse rows of an ascii ply vertex element in one go
+    def _readPlyAsciiVertices(self, plystream, element, count):
 
-        rows = []
-        plyfile = open(path, "rb")
-        getheader = False
-        count = 0
-        for row in plyfile:
-            #print(row.decode("ascii"))
-            # strip remove /r/n at the end of a row; split dived them into array
-            # the first row will be "ply\r\n"
-            if row.__contains__("ply"):
-                continue
-            if row.startswith("#"):
-                continue
-            if not getheader:
-                if row.__contains__("element vertex"):
-                    numberOfPoints = int(row.strip().split(" ")[-1])
-                    count = numberOfPoints
-                    print(numberOfPoints)
-                if row.__contains__("end_header"):
-                    getheader = True
-                    continue
-            else:
-                if count > 0:
-                    coordinates = [float(x) for x in row.strip().split(" ")]
-                    # only the vertex data, ignore other info
-                    rows.append(coordinates[:3]) # take the first 3 elements
-                    count -= 1
-                elif count <= 0:
-                    break
-        return rows
+        # input: stream positioned on a vertex row, the vertex element, number of rows to read
+        # output: float64 array of shape (count, 3), the x y z columns
 
-    # load file in off format
-    def offloader(self,path):
+        names = [prop.name for prop in element.properties]
+        block = b"".join(plystream.readline() for i in range(count))
+        values = np.fromstring(block, dtype=np.float64, sep=" ")
+        if len(values) != count * len(names):
+            raise plyfile.PlyElementParseError("expected %d values per row" % len(names), element)
+        values = values.reshape(count, len(names))
+        return values[:, [names.index("x"), names.index("y"), names.index("z")]]
 
-        #input: off file path
-        # output: X Y Z array
+    # look at the x y z fields of a structured vertex array as one (N, 3) array
+    def _plyXYZView(self, data):
 
-        rows = []
-        offfile = open(path)
-        getheader = False
-        for row in offfile:
-            # strip remove /r/n at the end of a row; split dived them into array
-            # the first row will be "OFF\r\n"
-            if row.__contains__("OFF"):# row == "OFF":
-                continue
-            if row.startswith("#"):
-                continue
-            if not getheader:
-                parameters = row.strip().split(" ")#[float(x) for x in row.strip().split(" ")]
-                numberOfPoints = parameters[0]
-                getheader = True
-                continue
+        # input: structured array with fields x, y and z (e.g. PlyElement.data)
+        # output: (N, 3) array sharing memory with data when x y z are adjacent and of one type
 
-            coordinates = [float(x) for x in row.strip().split(" ")]
-            # only the vertex data, ignore the face data
-            if len(coordinates) == 3:
-                rows.append(coordinates)
-            else:
+        fields = data.dtype.fields
+        x, y, z = fields["x"], fields["y"], fields["z"]
+        size = x[0].itemsize
+        if x[0] == y[0] == z[0] and y[1] == x[1] + size and z[1] == y[1] + size:
+            return np.ndarray((len(data), 3), dtype=x[0], buffer=data, offset=x[1],
+                              strides=(data.dtype.itemsize, size))
+        return np.column_stack((data["x"], data["y"], data["z"]))
+
+    # load file in off format
+    def offloader(self, path, withfaces=False):
+
+        #input: off file path, whether to read the faces too
+        # output: PointCloud of shape (N, 3); with withfaces also the faces, an (F, k) int array
+        #         when every face has k vertices, otherwise a list of int arrays
+
+        with open(path, "rb") as offfile:
+            numberOfPoints, numberOfFaces = self._readOffHeader(offfile, path)
+
+            # the header gives the number of vertex rows, parse exactly those in one go
+            rows = self._readOffRows(offfile, numberOfPoints)
+            cloud = self.asPointCloud(self._parseOffVertices(rows, numberOfPoints, path))
+            if not withfaces:
+                return cloud
+
+            faces = self._readOffFaces(offfile, numberOfFaces, path)
+        return cloud, faces
+
+    # parse vertex rows of an off file
+    def _parseOffVertices(self, rows, count, path):
+
+        # input: list of vertex rows, number of rows expected, file path for error messages
+        # output: float64 array of shape (count, 3)
+
+        values = np.fromstring(b"".join(rows), dtype=np.float64, sep=" ")
+        if len(rows) != count or len(values) < 3 * count or len(values) % max(count, 1) != 0:
+            raise ValueError("%s: expected %d vertex rows" % (path, count))
+        if count == 0:
+            return values.reshape(0, 3)
+        # colored (COFF) or normal (NOFF) vertices carry extra columns after x y z
+        return values.reshape(count, -1)[:, :3]
+
+    # read the off header up to and including the counts line
+    def _readOffHeader(self, offfile, path):
+
+        # input: off file opened in binary mode, its path for error messages
+        # output: number of vertices, number of faces; offfile is left on the first vertex row
+
+        counts = []
+        first = True
+        while len(counts) < 3:
+            row = offfile.readline()
+            if not row:
+                raise ValueError("%s: incomplete OFF header" % path)
+            # comments can appear anywhere in the header
+            fields = row.split(b"#")[0].split()
+            if first and fields:
+                # OFF, COFF, NOFF, STOFF ... the counts may follow on the same row
+                if not fields[0].endswith(b"OFF"):
+                    raise ValueError("%s: not an OFF file" % path)
+                fields = fields[1:]
+                first = False
+            counts.extend(int(x) for x in fields)
+        return counts[0], counts[1]
+
+    # read the next rows of an off file, leaving out comments and blank rows
+    def _readOffRows(self, offfile, count):
+
+        # input: off file opened in binary mode, number of rows wanted
+        # output: list of at most count rows (less only at the end of the file)
+
+        rows = []
+        while len(rows) < count:
+            row = offfile.readline()
+            if not row:
                 break
+            if row.lstrip().startswith(b"#") or not row.strip():
+                continue
+            rows.append(row)
         return rows
 
+    # read the face rows of an off file, each row is "k i1 i2 ... ik [r g b [a]]"
+    def _readOffFaces(self, offfile, numberOfFaces, path):
+
+        # input: off file positioned on the first face row, number of faces, its path
+        # output: (F, k) int array if all faces have k vertices, otherwise a list of int arrays
+
+        rows = self._readOffRows(offfile, numberOfFaces)
+        if len(rows) != numberOfFaces:
+            raise ValueError("%s: expected %d face rows" % (path, numberOfFaces))
+        if len(rows) == 0:
+            return np.empty((0, 3), dtype=np.int64)
+        columns = len(rows[0].split())
+        values = np.fromstring(b"".join(rows), dtype=np.float64, sep=" ")
+        if len(values) == numberOfFaces * columns:
+            values = values.reshape(numberOfFaces, columns)
+            k = int(values[0, 0])
+            if (values[:, 0] == k).all():
+                return values[:, 1:1+k].astype(np.int64)
+
+        # faces of different sizes, parse them row by row
+        faces = []
+        for row in rows:
+            fields = row.split()
+            if not fields:
+                raise ValueError("%s: expected %d face rows" % (path, numberOfFaces))
+            k = int(fields[0])
+            faces.append(np.array(fields[1:1+k], dtype=np.int64))
+        return faces
+
+    # load a point cloud file a fixed number of points at a time
+    def chunkloader(self, path, chunksize=1 << 20):
+
+        #input: point cloud file path, number of points per chunk
+        #output: generator of PointCloud chunks of chunksize points (the last one may be shorter),
+        #        only about one chunk is held in memory at a time for .pts, .ply and .off files
+
+        loader = self.chunkloaders.get(os.path.splitext(path)[1].lower())
+        if loader is not None:
+            for chunk in getattr(self, loader)(path, chunksize):
+                yield chunk
+            return
+
+        # other file types have no streaming reader, load them whole and hand out slices
+        cloud = self.load(path)
+        for start in range(0, len(cloud), chunksize):
+            yield cloud[start:start+chunksize]
+
+    # load file in pts format, chunksize points at a time
+    def ptschunkloader(self, path, chunksize=1 << 20):
+
+        #input: pts file path, number of points per chunk
+        #output: generator of PointCloud chunks
+
+        chunk = np.empty((chunksize, 3), dtype=self.dtype)
+        filled = 0
+        for coordinates in self._readPtsBlocks(path):
+            while len(coordinates):
+                take = min(chunksize - filled, len(coordinates))
+                chunk[filled:filled+take] = coordinates[:take]
+                coordinates = coordinates[take:]
+                filled += take
+                if filled == chunksize:
+                    yield self.asPointCloud(chunk)
+                    chunk = np.empty((chunksize, 3), dtype=self.dtype)
+                    filled = 0
+        if filled:
+            yield self.asPointCloud(chunk[:filled])
+
+    # load file in ply format, chunksize points at a time
+    def plychunkloader(self, path, chunksize=1 << 20):
+
+        #input: ply file path, number of points per chunk
+        #output: generator of PointCloud chunks
+
+        with open(path, "rb") as plystream:
+            plydata, element = self._readPlyHeader(plystream, path)
+            if plydata.text and not element._have_list:
+                for start in range(0, element.count, chunksize):
+                    count = min(chunksize, element.count - start)
+                    yield self.asPointCloud(self._readPlyAsciiVertices(plystream, element, count))
+                return
+            # binary vertices without list properties are memory mapped, a slice is only read
+            # from disk when its chunk is converted
+            element._read(plystream, plydata.text, plydata.byte_order)
+        for start in range(0, element.count, chunksize):
+            yield self.asPointCloud(self._plyXYZView(element.data[start:start+chunksize]))
+
+    # load file in off format, chunksize points at a time
+    def offchunkloader(self, path, chunksize=1 << 20):
+
+        #input: off file path, number of points per chunk
+        #output: generator of PointCloud chunks
+
+        with open(path, "rb") as offfile:
+            numberOfPoints, numberOfFaces = self._readOffHeader(offfile, path)
+            for start in range(0, numberOfPoints, chunksize):
+                count = min(chunksize, numberOfPoints - start)
+                rows = self._readOffRows(offfile, count)
+                yield self.asPointCloud(self._parseOffVertices(rows, count, path))
+
+    # calculate center of gravity of a point cloud given in chunks, in a single pass
+    def calculateCenterOfChunks(self, chunks):
+
+        # input: iterable of point cloud chunks, e.g. from chunkloader
+        # output: the center of gravity (with equal gravity)
+
+        total = np.zeros(3)
+        num = 0
+        for chunk in chunks:
+            chunk = self.asPointCloud(chunk)
+            total += chunk.sum(axis=0, dtype=np.float64)
+            num += len(chunk)
+        if num == 0:
+            return 0, 0, 0
+        Xsum, Ysum, Zsum = (total / num).tolist()
+        return Xsum, Ysum, Zsum
+
+    # calculate the axis aligned bounding box of a point cloud given in chunks, in a single pass
+    def calculateBoundingBox(self, chunks):
+
+        # input: iterable of point cloud chunks, e.g. from chunkloader (use [array] for a whole cloud)
+        # output: [xmin, ymin, zmin], [xmax, ymax, zmax]; None, None for an empty cloud
+
+        lower = np.full(3, np.inf)
+        upper = np.full(3, -np.inf)
+        for chunk in chunks:
+            chunk = self.asPointCloud(chunk)
+            if len(chunk):
+                lower = np.minimum(lower, chunk.min(axis=0))
+                upper = np.maximum(upper, chunk.max(axis=0))
+        if np.isinf(lower[0]):
+            return None, None
+        return lower.tolist(), upper.tolist()
+
+    # pick k points uniformly at random from a point cloud given in chunks, in a single pass
+    def subsampleChunks(self, chunks, k, seed=None):
+
+        # input: iterable of point cloud chunks, e.g. from chunkloader, number of points to keep, random seed
+        # output: PointCloud of min(k, N) points, every subset of that size being equally likely
+
+        # every point gets a random key and the k smallest keys win, so only k points
+        # and one chunk are ever held in memory
+        random = np.random.RandomState(seed)
+        sample = self.asPointCloud([])
+        keys = np.empty(0)
+        for chunk in chunks:
+            chunk = self.asPointCloud(chunk)
+            sample = np.concatenate((sample, chunk))
+            keys = np.concatenate((keys, random.random_sample(len(chunk))))
+            if len(keys) > k:
+                keep = np.argpartition(keys, k)[:k]
+                sample = sample[keep]
+                keys = keys[keep]
+        return self.asPointCloud(sample)
+
+    # keep one point per occupied cell of a grid of voxelsize cubes
+    def voxelDownsample(self, array, voxelsize, mode="centroid"):
+
+        # input: array from ptsloader1, edge length of the voxels, mode: "centroid" for the mean of the points
+        #        of each voxel, "representative" for the first of them (an original point)
+        # output: PointCloud of one point per occupied voxel, an upper bound voxelsize*sqrt(3) (the voxel
+        #         diagonal) of the hausdorff distance between it and the original cloud
+
+        if voxelsize <= 0:
+            raise ValueError("voxel size must be positive, got %r" % (voxelsize,))
+        if mode not in ("centroid", "representative"):
+            raise ValueError("unknown voxel mode %r" % (mode,))
+        cloud = np.asarray(self.asPointCloud(array))
+        if len(cloud) == 0:
+            return self.asPointCloud(cloud), 0.0
+
+        # every point is in the voxel of the point it is replaced with, and so is that point
+        keys = np.floor((cloud - cloud.min(axis=0)) / voxelsize).astype(np.int64)
+        extent = keys.max(axis=0) + 1
+        if float(extent[0]) * float(extent[1]) * float(extent[2]) < 2.0**62:
+            # one int64 per voxel, a 1D unique is many times faster than a unique of rows
+            keys = np.ravel_multi_index(keys.T, extent)
+            voxels, first, inverse, counts = np.unique(keys, return_index=True,
+                                                       return_inverse=True, return_counts=True)
+        else:
+            voxels, first, inverse, counts = np.unique(keys, axis=0, return_index=True,
+                                                       return_inverse=True, return_counts=True)
+        if mode == "representative":
+            sample = cloud[np.sort(first)]
+        else:
+            inverse = inverse.reshape(-1)
+            sample = np.empty((len(voxels), 3))
+            for axis in range(3):
+                sample[:, axis] = np.bincount(inverse, weights=cloud[:, axis], minlength=len(voxels)) / counts
+        return self.asPointCloud(sample), voxelsize * math.sqrt(3)
+
+    # pick k points, each time the one farthest from those already picked
+    def farthestPointSampling(self, array, k, start=0):
+
+        # input: array from ptsloader1, number of points to pick, index of the first one
+        # output: indices of the min(k, N) points picked, their covering radius r (every point is within r of
+        #         a picked one, so r bounds the hausdorff distance between the sample and the cloud)
+
+        # unlike a random sample this keeps the outliers, which are what a hausdorff distance depends on
+        cloud = np.asarray(self.asPointCloud(array))
+        k = min(k, len(cloud))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), (0.0 if len(cloud) == 0 else float('inf'))
+        indices = np.empty(k, dtype=np.int64)
+        indices[0] = start
+        # squared distance from every point to the nearest picked one, updated with each new point
+        nearest = ((cloud - cloud[start])**2).sum(axis=1)
+        for step in range(1, k):
+            indices[step] = np.argmax(nearest)
+            np.minimum(nearest, ((cloud - cloud[indices[step]])**2).sum(axis=1), out=nearest)
+        return indices, math.sqrt(float(nearest.max()))
+
+    # the clouds the distance functions work on for their voxelsize and samples options
+    def _reduceClouds(self, array1, array2, voxelsize, samples, centered=False):
+
+        # input: array for the two point cloud obtained from ptsloader1, voxel size for voxelDownsample,
+        #        number of points kept by farthestPointSampling (None to skip either), centered: the distance
+        #        moves each cloud to its own center of gravity first, as calculateGromovHausdorffDistance does
+        # output: the two reduced clouds, the most a hausdorff or gromov-hausdorff distance between them
+        #         can differ from the one between the inputs (the sum of their distances to the inputs,
+        #         plus how far their centers moved when centered)
+
+        clouds = []
+        error = 0.0
+        for array in (array1, array2):
+            cloud = self.asPointCloud(array)
+            center = np.array(self.calculateCenter(cloud))
+            if voxelsize is not None:
+                cloud, radius = self.voxelDownsample(cloud, voxelsize)
+                error += radius
+            if samples is not None:
+                indices, radius = self.farthestPointSampling(cloud, samples)
+                cloud = self.asPointCloud(cloud[indices])
+                error += radius
+            if centered:
+                # neither the voxel centroids nor the samples keep the point weights, so the center moves
+                error += float(np.linalg.norm(np.array(self.calculateCenter(cloud)) - center))
+            clouds.append(cloud)
+        return clouds[0], clouds[1], error
+
     def extractXYZ(self, array):
 
         #input: array return from myload
         #output: X Y Z array
 
-        X = []
-        Y = []
-        Z = []
-        for coordinates in array:
-            X.append(coordinates[0])
-            Y.append(coordinates[1])
-            Z.append(coordinates[2])
-        return X,Y,Z
+        cloud = np.asarray(self.asPointCloud(array))
+        return cloud[:, 0], cloud[:, 1], cloud[:, 2]
 
     # plot data in 3D and show
     def myplot(self, path):
@@ -170,46 +769,167 @@ class MyPointCloudUtil(object):
         plt.show()
 
     # extract number of points, diameter and separation
-    def getProperties(self, array):
+    def getProperties(self, array, ignoreduplicates=False):
 
-        #input: array from ptsloader1
+        #input: array from ptsloader1, whether repeated points count as separation 0
         #output: some properties
 
-        # the first dimension
-        length = len(array)
+        cloud = self.asPointCloud(array)
 
-        # longest point distance in this point cloud, initialize to 0
-        diameter = 0
+        # the first dimension
+        length = len(cloud)
 
-        # shortest point distance in this point cloud, initialize to be the infinity
-        separation = float('inf')
+        # longest point distance in this point cloud
+        diameter, i, j = self.calculateDiameter(cloud)
 
-        for i in range(length-1):
-            for j in range(i+1, length):
-                distance = math.sqrt((array[i][0]-array[j][0])**2 + (array[i][1]-array[j][1])**2 + (array[i][2]-array[j][2])**2)
-                if distance > diameter:
-                    diameter = distance
-                if distance < separation:
-                    separation = distance
+        # shortest point distance in this point cloud, infinity for less than 2 points
+        separation, i, j = self.calculateSeparation(cloud, ignoreduplicates)
 
         return length, diameter, separation
 
-    # calculate diameter direction
-    def calculateDiameterDirection(self, array):
+    # calculate the separation (shortest point distance) and the two points realizing it
+    def calculateSeparation(self, array, ignoreduplicates=False):
+
+        # input: array from ptsloader1, whether to skip pairs of identical points
+        # output: separation, index of the two closest points (inf, 0, 0 if there is no such pair)
+
+        cloud = np.asarray(self.asPointCloud(array))
+        indices = np.arange(len(cloud))
+        if ignoreduplicates:
+            # keep one of each group of identical points, remembering where it came from
+            cloud, indices = np.unique(cloud, axis=0, return_index=True)
+        if len(cloud) < 2:
+            return float('inf'), 0, 0
+
+        if cKDTree is not None:
+            # the nearest neighbour of each point other than itself, O(N log N)
+            distances, neighbours = cKDTree(cloud).query(cloud, k=2)
+            i = int(np.argmin(distances[:, 1]))
+            # with repeated points the point itself can come second
+            j = neighbours[i, 1] if neighbours[i, 1] != i else neighbours[i, 0]
+            return float(distances[i, 1]), int(indices[i]), int(indices[j])
+
+        # without scipy compare every pair i < j, a tile at a time
+        separation, i, j = self.calculatePairwiseDistances(cloud, cloud, "min", triangle=True)
+        return separation, int(indices[i]), int(indices[j])
+
+    # calculate the diameter (longest point distance) and the two points realizing it
+    def calculateDiameter(self, array):
 
         # input: array from ptsloader1
-        # output: the diameter direction (if many, the last one)
-
-        length = len(array)
-        diameter = 0
-        direction = [0,0,0]
-        for i in range(length-1):
-            for j in range(i+1, length):
-                distance = math.sqrt((array[i][0]-array[j][0])**2 + (array[i][1]-array[j][1])**2 + (array[i][1]-array[j][1])**2)
-                if distance > diameter:
-                    diameter = distance
-                    direction=[array[i][0]-array[j][0], array[i][1]-array[j][1],array[i][1]-array[j][1]]
-        return direction
+        # output: diameter, index of the two farthest points (0, 0, 0 for less than 2 points)
+
+        # the farthest pair is always a pair of convex hull vertices, so only those are compared
+        cloud = np.asarray(self.asPointCloud(array))
+        if len(cloud) < 2:
+            return 0.0, 0, 0
+        candidates = self._hullVertices(cloud)
+        hull = cloud[candidates]
+
+        diameter, i, j = self.calculatePairwiseDistances(hull, hull, "max", triangle=True)
+        return diameter, int(candidates[i]), int(candidates[j])
+
+    # approximate the diameter in linear time from the extreme points along a set of directions
+    def calculateApproximateDiameter(self, array, epsilon=0.05):
+
+        # input: array from ptsloader1, the relative error allowed (0 < epsilon < 1)
+        # output: d with (1-epsilon)*diameter <= d <= diameter, index of the two points at distance d
+
+        # if every direction is within angle t of one of the sampled directions, the extremes along the
+        # direction closest to the diameter are at least diameter*cos(t) apart
+        cloud = np.asarray(self.asPointCloud(array))
+        if len(cloud) < 2:
+            return 0.0, 0, 0
+        directions = self._coveringDirections(epsilon)
+
+        rows = np.arange(len(directions))
+        lowest = np.zeros(len(directions), dtype=np.int64)
+        highest = np.zeros(len(directions), dtype=np.int64)
+        lowvalue = np.full(len(directions), np.inf)
+        highvalue = np.full(len(directions), -np.inf)
+        # about four million projections per block
+        blocksize = max(1, (1 << 22) // len(directions))
+        for start in range(0, len(cloud), blocksize):
+            # one row per direction, so the reductions run over contiguous memory
+            projections = directions.dot(cloud[start:start+blocksize].T)
+            imin = projections.argmin(axis=1)
+            imax = projections.argmax(axis=1)
+            values = projections[rows, imin]
+            better = values < lowvalue
+            lowvalue[better] = values[better]
+            lowest[better] = start + imin[better]
+            values = projections[rows, imax]
+            better = values > highvalue
+            highvalue[better] = values[better]
+            highest[better] = start + imax[better]
+
+        # the exact diameter of the few extreme points
+        candidates = np.unique(np.concatenate((lowest, highest)))
+        diameter, i, j = self.calculateDiameter(cloud[candidates])
+        return diameter, int(candidates[i]), int(candidates[j])
+
+    # unit directions such that every direction is close enough to one of them (up to sign)
+    def _coveringDirections(self, epsilon):
+
+        # input: the relative error allowed (0 < epsilon < 1)
+        # output: (M, 3) array of unit vectors, every unit vector u has one v with |u.v| >= 1-epsilon
+
+        if not 0 < epsilon < 1:
+            raise ValueError("epsilon must be between 0 and 1, got %r" % (epsilon,))
+        # grid on the faces x=1, y=1, z=1 of the cube; a point p of a face is at most spacing/sqrt(2)
+        # from a grid point q, and since |q| >= 1 the angle between p and q has sine at most that
+        angle = math.acos(1 - epsilon)
+        spacing = math.sqrt(2) * math.sin(angle)
+        n = int(math.ceil(2 / spacing)) + 1
+        grid = np.linspace(-1, 1, n)
+        # the faces share their edges up to sign ((1, 1, b) and (1, -1, b) = -(-1, 1, -b) are both on
+        # x=1), so y=1 leaves out the rows at x=+-1 and z=1 also those at y=+-1
+        a, b = [g.ravel() for g in np.meshgrid(grid, grid)]
+        inner = grid[1:-1]
+        c, d = [g.ravel() for g in np.meshgrid(inner, grid)]
+        e, f = [g.ravel() for g in np.meshgrid(inner, inner)]
+        directions = np.concatenate((np.column_stack((np.ones(len(a)), a, b)),
+                                     np.column_stack((c, np.ones(len(c)), d)),
+                                     np.column_stack((e, f, np.ones(len(e))))))
+        return directions / np.sqrt((directions**2).sum(axis=1))[:, None]
+
+    # indices of the points of a cloud that are vertices of its convex hull
+    def _hullVertices(self, cloud):
+
+        # input: (N, 3) array
+        # output: int array of indices into cloud, all of them if scipy is not installed
+
+        if ConvexHull is None or len(cloud) < 5:
+            return np.arange(len(cloud))
+        try:
+            return ConvexHull(cloud).vertices
+        except RuntimeError:
+            pass
+
+        # qhull rejects flat clouds, take the 2D hull in the plane of the points instead
+        centered = cloud - cloud.mean(axis=0)
+        axes = np.linalg.svd(centered, full_matrices=False)[2]
+        projected = centered.dot(axes[:2].T)
+        try:
+            return ConvexHull(projected).vertices
+        except RuntimeError:
+            # all points on a line (or the same point)
+            return np.array([np.argmin(projected[:, 0]), np.argmax(projected[:, 0])])
+
+    # calculate diameter direction
+    def calculateDiameterDirection(self, array, epsilon=None):
+
+        # input: array from ptsloader1, relative error allowed (None for the exact diameter)
+        # output: the diameter direction, the vector between the two farthest points
+
+        cloud = self.asPointCloud(array)
+        if epsilon is None:
+            diameter, i, j = self.calculateDiameter(cloud)
+        else:
+            diameter, i, j = self.calculateApproximateDiameter(cloud, epsilon)
+        if diameter == 0:
+            return [0,0,0]
+        return (cloud[i] - cloud[j]).tolist()
 
     # calculate the angle between two 3D arrow
     def calculateRadianBetweenDirections(self, direction1, direction2):
@@ -219,7 +939,7 @@ class MyPointCloudUtil(object):
 
         numerator = direction1[0]*direction2[0] + direction1[1]*direction2[1] + direction1[2]*direction2[2]
         denominator = math.sqrt(direction1[0]**2 + direction1[1]**2 + direction1[2]**2) * math.sqrt(direction2[0]**2 + direction2[1]**2 + direction2[2]**2)
-        costheta = numerator / denominator
+        costheta = max(-1.0, min(1.0, numerator / denominator))
         theta = math.acos(costheta) # return radian, not angle
 
         return theta
@@ -243,77 +963,255 @@ class MyPointCloudUtil(object):
         # input: the normal vector of the two direction, the point cloud array, and the rotate angle
         # output: the rotated array according to the normal vector
 
-        # first normalize the normal vector
-        normallength = math.sqrt(normal[0]**2 + normal[1]**2 + normal[2]**2)
-        normal[0] /= normallength
-        normal[1] /= normallength
-        normal[2] /= normallength
+        # calculate the rotated array.
+        cloud = self.asPointCloud(array)
+        self.transform(cloud, self.rotationMatrixFromAxisAngle(normal, angle), out=cloud)
+        self._writeBack(array, cloud)
 
-        # get the support value
-        radian = math.radians(angle)
-        c = math.cos(radian)
-        s = math.sin(radian)
-        x = normal[0]
-        y = normal[1]
-        z = normal[2]
+    # brute force, or nearest neighbour queries on a k-d tree of each cloud, or early break
+    def calculateHausdorffDistance(self, array1, array2, method="auto", voxelsize=None, samples=None):
 
-        # calculate the rotated array.
-        for coordinate in array:
-            tempx = coordinate[0]
-            tempy = coordinate[1]
-            tempz = coordinate[2]
-            coordinate[0] = (x**2 *(1-c) + c) * tempx + (x*y *(1-c)-z*s) * tempy + (x*z*(1-c) + y*s) * tempz
-            coordinate[1] = (x*y*(1-c) + z*s) * tempx + (y**2*(1-c) + c) * tempy + (y*z*(1-c) - x*z) * tempz
-            coordinate[2] = (x*z*(1-c) - y*s) * tempx + (y*z*(1-c) +x*s) * tempy + (z**2 *(1-c) + c) * tempz
+        #input: array for the two point cloud obtained from ptsloader1, method: "bruteforce" O(N*M),
+        #       "kdtree" O((N+M) log N), "earlybreak" (see calculateEarlyBreakDirectedHausdorff),
+        #       "auto" (kdtree when scipy is installed), voxelsize: compare the voxelDownsample of both clouds,
+        #       samples: compare samples points of each cloud picked by farthestPointSampling
+        #ouput: the hausdorff distance; with voxelsize or samples the distance of the reduced clouds, the most
+        #       it can differ from the full resolution one
 
+        if voxelsize is not None or samples is not None:
+            array1, array2, error = self._reduceClouds(array1, array2, voxelsize, samples)
+            return self.calculateHausdorffDistance(array1, array2, method), error
 
-    # brute force
-    def calculateHausdorffDistance(self, array1, array2):
-
-        #input: array for the two point cloud obtained from ptsloader1
-        #ouput: the hausdorff distance
-
-        distance1to2outside = []
-        distance1to2inside = []
-        for coordinate1 in array1:
-            for coordinate2 in array2:
-                distance = math.sqrt((coordinate1[0]-coordinate2[0])**2 + (coordinate1[1]-coordinate2[1])**2 + (coordinate1[2]-coordinate2[2])**2)
-                distance1to2inside.append(distance)
-            inf = min(distance1to2inside)
-            distance1to2outside.append(inf)
-            distance1to2inside = []
-        sup1 = max(distance1to2outside)
-
-        distance2to1outside = []
-        distance2to1inside = []
-        for coordinate1 in array2:
-            for coordinate2 in array1:
-                distance = math.sqrt((coordinate2[0]-coordinate1[0])**2 + (coordinate2[1]-coordinate1[1])**2 + (coordinate2[2]-coordinate1[2])**2)
-                distance2to1inside.append(distance)
-            inf = min(distance2to1inside)
-            distance2to1outside.append(inf)
-            distance2to1inside = []
-        sup2 = max(distance2to1outside)
+        cloud1 = self.asPointCloud(array1)
+        cloud2 = self.asPointCloud(array2)
+
+        if method == "earlybreak":
+            # the second direction only matters where it beats the first one
+            sup1 = self.calculateEarlyBreakDirectedHausdorff(cloud1, cloud2)
+            return self.calculateEarlyBreakDirectedHausdorff(cloud2, cloud1, lowerbound=sup1)
+
+        sup1 = self.calculateDirectedHausdorffDistance(cloud1, cloud2, method)
+        sup2 = self.calculateDirectedHausdorffDistance(cloud2, cloud1, method)
 
         return max(sup1,sup2)
 
+    # one direction only: the farthest point of array1 from array2
+    def calculateDirectedHausdorffDistance(self, array1, array2, method="auto", index2=None):
+
+        #input: array for the two point cloud obtained from ptsloader1, method as in calculateHausdorffDistance,
+        #       index2: buildSpatialIndex(array2) if already built (kdtree method only)
+        #ouput: max over points of array1 of the distance to the nearest point of array2
+
+        cloud1 = self.asPointCloud(array1)
+        if method == "auto":
+            method = "kdtree" if cKDTree is not None else "bruteforce"
+
+        if method == "earlybreak":
+            return self.calculateEarlyBreakDirectedHausdorff(cloud1, array2)
+        if method == "kdtree":
+            if len(cloud1) == 0:
+                return 0.0
+            if index2 is None:
+                index2 = self.buildSpatialIndex(array2)
+            distances, indices = index2.query(cloud1)
+            return float(distances.max())
+        if method != "bruteforce":
+            raise ValueError("unknown Hausdorff method %r" % (method,))
+
+        if len(cloud1) == 0:
+            return 0.0
+        distances, indices = self.calculatePairwiseDistances(cloud1, array2, "rowmin")
+        return float(distances.max())
+
+    # exact directed hausdorff distance with early break, Taha & Hanbury 2015
+    def calculateEarlyBreakDirectedHausdorff(self, array1, array2, lowerbound=0.0, seed=None, blocksize=256):
+
+        #input: array for the two point cloud obtained from ptsloader1, a value the result is known to be
+        #       at least (only larger values are searched for), random seed, number of points of each cloud
+        #       compared at once
+        #ouput: max(lowerbound, max over points of array1 of the distance to the nearest point of array2)
+
+        # in random order a point of array2 close to the current point of array1 turns up early,
+        # and as soon as one is closer than the running max the point cannot raise the max any more
+        cloud1 = np.asarray(self.asPointCloud(array1))
+        cloud2 = np.asarray(self.asPointCloud(array2))
+        if directed_hausdorff is not None and len(cloud1) and len(cloud2):
+            # scipy runs the same search in compiled code
+            return max(float(lowerbound), float(directed_hausdorff(cloud1, cloud2, seed or 0)[0]))
+
+        # without scipy whole blocks of points of array1 are compared at once and dropped as they break
+        random = np.random.RandomState(seed)
+        cloud1 = cloud1[random.permutation(len(cloud1))]
+        # one row per coordinate, so each tile below is three contiguous 2D passes
+        columns2 = np.ascontiguousarray(cloud2[random.permutation(len(cloud2))].T)
+
+        # compare squared distances, take the square root once at the end
+        cmax = float(lowerbound)**2
+        for outer in range(0, len(cloud1), blocksize):
+            # the points of this block that may still raise the max, with their nearest distance so far
+            points = cloud1[outer:outer+blocksize]
+            cmin = np.full(len(points), np.inf)
+            for start in range(0, columns2.shape[1], blocksize):
+                block = columns2[:, start:start+blocksize]
+                distances = (points[:, 0, None] - block[0])**2
+                distances += (points[:, 1, None] - block[1])**2
+                distances += (points[:, 2, None] - block[2])**2
+                np.minimum(cmin, distances.min(axis=1), out=cmin)
+                alive = cmin >= cmax
+                if not alive.all():
+                    points = points[alive]
+                    cmin = cmin[alive]
+                    if len(points) == 0:
+                        break
+            # the points left compared with the whole of array2
+            if len(cmin):
+                cmax = max(cmax, float(cmin.max()))
+        return math.sqrt(cmax)
+
+    # hausdorff distance between array1 rotated by each of a batch of rotations and array2
+    def calculateBatchHausdorffDistance(self, array1, array2, rotations, index1=None, index2=None,
+                                        buffer=None, directed=False, maxpoints=1 << 22):
+
+        #input: array for the two point cloud obtained from ptsloader1 (rotations turn around the origin),
+        #       (K, 3, 3) rotation matrices, buildSpatialIndex of array1 and of array2 if already built,
+        #       buffer: float64 array from _rotationBuffer reused for the rotated points (a smaller one is
+        #       replaced by a new one),
+        #       directed: only the distance from the rotated array1 to array2,
+        #       maxpoints: number of rotated points queried at once
+        #ouput: array of K hausdorff distances
+
+        cloud1 = np.asarray(self.asPointCloud(array1), dtype=np.float64)
+        cloud2 = np.asarray(self.asPointCloud(array2), dtype=np.float64)
+        rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+        if cKDTree is None:
+            if directed:
+                return np.array([self.calculateDirectedHausdorffDistance(self.transform(cloud1, rotation), cloud2)
+                                 for rotation in rotations])
+            return np.array([self.calculateHausdorffDistance(self.transform(cloud1, rotation), cloud2)
+                             for rotation in rotations])
+        if index2 is None:
+            index2 = self.buildSpatialIndex(cloud2)
+        if index1 is None and not directed:
+            index1 = self.buildSpatialIndex(cloud1)
+
+        # rotate as many copies as fit in maxpoints at once and query them in one call
+        batch = max(1, maxpoints // max(len(cloud1), len(cloud2), 1))
+        if buffer is None or len(buffer) < 3 * min(batch, len(rotations)) * max(len(cloud1), len(cloud2)):
+            buffer = self._rotationBuffer(cloud1, cloud2, len(rotations), maxpoints)
+        distances = np.empty(len(rotations))
+        for start in range(0, len(rotations), batch):
+            part = rotations[start:start+batch]
+            # rows are points: R a for every row a is cloud1 * R^T
+            rotated = buffer[:3*len(part)*len(cloud1)].reshape(len(part), len(cloud1), 3)
+            np.matmul(cloud1, part.transpose(0, 2, 1), out=rotated)
+            nearest = index2.query(rotated.reshape(-1, 3))[0]
+            distances[start:start+len(part)] = nearest.reshape(len(part), -1).max(axis=1)
+            if directed:
+                continue
+            # the other direction without a tree of each rotated cloud: |b - R a| = |R^T b - a|
+            rotated = buffer[:3*len(part)*len(cloud2)].reshape(len(part), len(cloud2), 3)
+            np.matmul(cloud2, part, out=rotated)
+            nearest = index1.query(rotated.reshape(-1, 3))[0]
+            np.maximum(distances[start:start+len(part)], nearest.reshape(len(part), -1).max(axis=1),
+                       out=distances[start:start+len(part)])
+        return distances
+
+    # the buffer calculateBatchHausdorffDistance rotates copies of a cloud into, allocate once per search
+    def _rotationBuffer(self, array1, array2, count, maxpoints=1 << 22):
+
+        #input: array for the two point cloud obtained from ptsloader1, the most rotations scored per call,
+        #       maxpoints as in calculateBatchHausdorffDistance
+        #ouput: float64 array big enough for one batch of rotated points
+
+        size = max(len(array1), len(array2), 1)
+        return np.empty(3 * min(max(1, maxpoints // size), max(count, 1)) * size)
+
+    # build the spatial index used for nearest neighbour queries
+    def buildSpatialIndex(self, array):
+
+        #input: array for the point cloud obtained from ptsloader1
+        #output: scipy.spatial.cKDTree of the points
+
+        if cKDTree is None:
+            raise ImportError("scipy is required for k-d tree queries")
+        return cKDTree(np.asarray(self.asPointCloud(array)))
+
+    # reduce the distances between the points of array1 and those of array2 one tile at a time
+    def calculatePairwiseDistances(self, array1, array2, reduction="rowmin", tilesize=1024, triangle=False):
+
+        #input: array for the two point cloud obtained from ptsloader1, reduction: "rowmin" / "rowmax" (for each
+        #       point of array1 the distance to the nearest / farthest point of array2), "min" / "max" (over
+        #       all pairs), tilesize: points of each cloud per tile, so about 8*tilesize**2 bytes of work memory,
+        #       triangle: only the pairs i < j, for array1 and array2 being the same cloud
+        #ouput: rowmin / rowmax: distances, index of that point of array2 (inf / -inf, 0 for a row without pairs);
+        #       min / max: distance, index in array1, index in array2 (inf / 0, 0, 0 without pairs)
+
+        if reduction not in ("rowmin", "rowmax", "min", "max"):
+            raise ValueError("unknown reduction %r" % (reduction,))
+        cloud1 = np.asarray(self.asPointCloud(array1), dtype=np.float64)
+        cloud2 = np.asarray(self.asPointCloud(array2), dtype=np.float64)
+        smallest = reduction in ("rowmin", "min")
+        fill = np.inf if smallest else -np.inf
+
+        # the best so far of each row, the full matrix is never held
+        values = np.full(len(cloud1), fill)
+        indices = np.zeros(len(cloud1), dtype=np.int64)
+        for start1, start2, squared in self._distanceTiles(cloud1, cloud2, tilesize, triangle):
+            if triangle and start2 <= start1 + len(squared):
+                rows, columns = np.tril_indices(len(squared), start1 - start2, squared.shape[1])
+                squared[rows, columns] = fill
+            columns = squared.argmin(axis=1) if smallest else squared.argmax(axis=1)
+            best = squared[np.arange(len(squared)), columns]
+            current = values[start1:start1+len(squared)]
+            better = best < current if smallest else best > current
+            current[better] = best[better]
+            indices[start1:start1+len(squared)][better] = columns[better] + start2
+
+        # the expansion loses precision for close points, so the distances found are computed again directly
+        found = np.isfinite(values)
+        values[found] = np.sqrt(((cloud1[found] - cloud2[indices[found]])**2).sum(axis=1))
+        if reduction in ("rowmin", "rowmax"):
+            return values, indices
+        if not found.any():
+            return (float('inf') if smallest else 0.0), 0, 0
+        i = int(np.argmin(values) if smallest else np.argmax(values))
+        return float(values[i]), i, int(indices[i])
+
+    # squared distances between tiles of tilesize points of cloud1 and of cloud2,
+    # from |a|^2 + |b|^2 - 2 a.b so a tile is one matrix product
+    def _distanceTiles(self, cloud1, cloud2, tilesize, triangle=False):
+        cloud1 = np.asarray(cloud1, dtype=np.float64)
+        cloud2 = np.asarray(cloud2, dtype=np.float64)
+        if len(cloud1) == 0 or len(cloud2) == 0:
+            return
+        # near the origin the expansion cancels less
+        shift = cloud1.mean(axis=0)
+        cloud1 = cloud1 - shift
+        cloud2 = cloud2 - shift
+        norms1 = (cloud1**2).sum(axis=1)
+        norms2 = (cloud2**2).sum(axis=1)
+        for start1 in range(0, len(cloud1), tilesize):
+            block1 = cloud1[start1:start1+tilesize]
+            # with triangle the tiles left of the diagonal hold no pair i < j
+            for start2 in range(start1 if triangle else 0, len(cloud2), tilesize):
+                squared = block1.dot(cloud2[start2:start2+tilesize].T)
+                squared *= -2
+                squared += norms1[start1:start1+tilesize, None]
+                squared += norms2[None, start2:start2+tilesize]
+                np.maximum(squared, 0, out=squared)
+                yield start1, start2, squared
+
     # calculate center of gravity (with equal gravity)
     def calculateCenter(self,array):
 
         # input: array for the two point cloud obtained from ptsloader1,
         # ouput: the center of gravity (with equal gravity)
 
-        num = len(array)
-        if num == 0:
+        cloud = self.asPointCloud(array)
+        if len(cloud) == 0:
             return 0, 0, 0
-        Xsum, Ysum, Zsum = 0.0, 0.0, 0.0
-        for coordinates in array:
-            Xsum += coordinates[0]
-            Ysum += coordinates[1]
-            Zsum += coordinates[2]
-        Xsum /= num
-        Ysum /= num
-        Zsum /= num
+        # accumulate in float64 even for float32 clouds
+        Xsum, Ysum, Zsum = cloud.mean(axis=0, dtype=np.float64).tolist()
 
         return Xsum, Ysum, Zsum
 
@@ -324,18 +1222,14 @@ class MyPointCloudUtil(object):
         # input: array for the two point cloud obtained from ptsloader1, footstep(angle) for each rotation
         # output: modify array1 and array2 to make gravity center overlap with origin point
 
-        Xcenter1, Ycenter1, Zcenter1 = self.calculateCenter(array1)
-        Xcenter2, Ycenter2, Zcenter2 = self.calculateCenter(array2)
+        cloud1 = self.asPointCloud(array1)
+        cloud2 = self.asPointCloud(array2)
 
-        for coordinates in array1:
-            coordinates[0] -= Xcenter1
-            coordinates[1] -= Ycenter1
-            coordinates[2] -= Zcenter1
+        cloud1 -= np.array(self.calculateCenter(cloud1), dtype=cloud1.dtype)
+        cloud2 -= np.array(self.calculateCenter(cloud2), dtype=cloud2.dtype)
 
-        for coordinates in array2:
-            coordinates[0] -= Xcenter2
-            coordinates[1] -= Ycenter2
-            coordinates[2] -= Zcenter2
+        self._writeBack(array1, cloud1)
+        self._writeBack(array2, cloud2)
 
                 # Xdiff = Xcenter1 - Xcenter2
         # Ydiff = Ycenter1 - Ycenter2
@@ -347,43 +1241,346 @@ class MyPointCloudUtil(object):
         #print(array2)
 
     # brute force
-    def calculateGromovHausdorffDistance(self, footstep, array1, array2):
-
-        # input: array for the two point cloud obtained from ptsloader1, footstep(angle) for each rotation
-        # ouput: the discrete gromov-hausdorff distance
+    def calculateGromovHausdorffDistance(self, footstep, array1, array2, sampler="euler", refine=0, align=False,
+                                         voxelsize=None, samples=None):
+
+        # input: array for the two point cloud obtained from ptsloader1, footstep(angle) for each rotation,
+        #        sampler: "euler" for every X, Y, Z angle multiple of footstep, "uniform" for sampleRotations at
+        #        0.75 footstep, which leaves no larger gap than the euler grid (about 0.8 footstep) with about
+        #        half as many rotations, "branchandbound" for
+        #        searchRotationsBranchAndBound refined down to footstep,
+        #        refine: number of the best rotations of the search polished by refineRotation afterwards,
+        #        align: also score the principal axes alignment of calculatePCAUpperBound, which seeds the
+        #        pruning of "branchandbound" and is a candidate for refine,
+        #        voxelsize: search between the voxelDownsample of both clouds (the inputs are then not moved),
+        #        samples: search between samples points of each cloud picked by farthestPointSampling
+        # ouput: the discrete gromov-hausdorff distance; with voxelsize or samples that of the reduced clouds,
+        #        the most it can differ from the full resolution one
+
+        if voxelsize is not None or samples is not None:
+            array1, array2, error = self._reduceClouds(array1, array2, voxelsize, samples, centered=True)
+            return self.calculateGromovHausdorffDistance(footstep, array1, array2, sampler, refine, align), error
 
         # overlap their center of gravity
         self.overlapCenterOfGravity(array1,array2)
+        array1 = self.asPointCloud(array1)
+        array2 = self.asPointCloud(array2)
+
+        seeds = None
+        if align:
+            pcadistance, pcarotation = self.calculatePCAUpperBound(array1, array2)
+            # the principal axes already match, no search can do better
+            if pcadistance < 0.0000001:
+                return 0
+            seeds = [pcarotation]
+
+        if sampler == "euler":
+            ghdistance, candidates, angles = self._searchEulerGrid(footstep, array1, array2, max(refine, 1))
+        elif sampler == "uniform":
+            # the euler grid is within about 0.8 footstep of every rotation, the spiral within its resolution
+            rotations = self.iterSampleRotations(0.75 * footstep)
+            ghdistance, candidates = self._searchRotations(rotations, array1, array2, max(refine, 1))
+        elif sampler == "branchandbound":
+            ghdistance, rotation, evaluated, pruned = self.searchRotationsBranchAndBound(array1, array2, footstep,
+                                                                                          seeds)
+            seeds = None
+            candidates = [rotation]
+        else:
+            raise ValueError("unknown rotation sampler %r" % (sampler,))
+        if seeds is not None:
+            # the principal axes rotation goes first if it beats the grid, otherwise right after its best
+            candidates = np.asarray(candidates).reshape(-1, 3, 3)
+            position = 0 if pcadistance < ghdistance else 1
+            candidates = np.concatenate((candidates[:position], seeds, candidates[position:]))
+            ghdistance = min(ghdistance, pcadistance)
+
+        # the grid is only accurate to footstep, a local search from its best points closes the gap
+        for rotation in candidates[:refine]:
+            if ghdistance < 0.0000001:
+                break
+            ghdistance = min(ghdistance, self.refineRotation(array1, array2, rotation, footstep / 2.0)[0])
 
-        # using rotation
-        count = 0;
-        ghdistance = self.calculateHausdorffDistance(array1, array2)
-        for x in range(0,360,footstep):
-            for y in range(0,360,footstep):
-                for z in range(0,360,footstep):
-
-                    #array1 = self.rotate(footstep,array1,'Z')
-                    self.rotate(footstep, array1, 'Z')
-                    distance = self.calculateHausdorffDistance(array1, array2)
-                    count += 1;
-                    #print(count / (360.0/footstep)**3)
-                    #print(distance, ghdistance)
+        # if totally the same or the difference is small enough, we treat it as equal
+        if ghdistance < 0.0000001:
+            return 0
+        return ghdistance
 
-                    if distance < ghdistance:
-                        ghdistance = distance
+    # smallest hausdorff distance over the rotations Rz(z)*Ry(y)*Rx(x) of all angles multiple of footstep
+    def _searchEulerGrid(self, footstep, array1, array2, keep=1, xangles=None, index1=None, index2=None, stop=None):
 
-                    # if totally the same, break the loop and return
-                    # if the difference is small enough, we treat it as equal
-                    if ghdistance == 0 or ghdistance < 0.0000001:
-                        #print(count)
-                        return 0
+        # input: footstep(angle) for each rotation, array for the two point cloud (centered),
+        #        number of best rotations to return, the X angles to search (None for all of them),
+        #        buildSpatialIndex of both if already built, multiprocessing.Event telling the search to give up
+        #        (it is set when a match is found)
+        # ouput: the smallest hausdorff distance (stops below the zero threshold), the best rotations,
+        #        their (x, y, z) Euler angles
 
-                #array1 = self.rotate(footstep, array1, 'Y')
-                self.rotate(footstep, array1, 'Y')
-            #array1 = self.rotate(footstep, array1, 'X')
-            self.rotate(footstep, array1, 'X')
+        # using rotation
+        # every rotation is applied to the original array1, so no rounding error builds up,
+        # the rotations around Z for one X and Y are scored together as one batch
+        if cKDTree is not None:
+            if index1 is None:
+                index1 = self.buildSpatialIndex(array1)
+            if index2 is None:
+                index2 = self.buildSpatialIndex(array2)
+        if xangles is None:
+            xangles = range(0,360,footstep)
+        zangles = range(0,360,footstep)
+        buffer = self._rotationBuffer(array1, array2, len(zangles))
+        best = (np.array([float('inf')]), np.zeros((1, 3), dtype=np.int64))
+        for x in xangles:
+            for y in range(0,360,footstep):
+                if stop is not None and stop.is_set():
+                    break
+                rotations = np.array([self.rotationMatrixFromEuler(x, y, z) for z in zangles])
+                distances = self.calculateBatchHausdorffDistance(array1, array2, rotations, index1, index2, buffer)
+                # the best are kept as angles, their matrices are built again at the end
+                best = self._keepBest(best, distances, np.array([(x, y, z) for z in zangles]), keep)
+
+                # if totally the same, break the loop and return
+                if best[0][0] < 0.0000001:
+                    if stop is not None:
+                        stop.set()
+                    break
+            else:
+                continue
+            break
+
+        distances, angles = best[0][np.isfinite(best[0])], best[1][np.isfinite(best[0])]
+        rotations = np.array([self.rotationMatrixFromEuler(x, y, z) for x, y, z in angles]).reshape(-1, 3, 3)
+        return float(best[0][0]), rotations, [tuple(int(a) for a in angle) for angle in angles]
+
+    # smallest hausdorff distance over a list of rotations of array1
+    def _searchRotations(self, rotations, array1, array2, keep=1, batchsize=64):
+
+        # input: (K, 3, 3) rotations or an iterable of batches of them (e.g. iterSampleRotations), array for the
+        #        two point cloud (centered), number of best rotations to return, rotations scored per batch
+        # ouput: the smallest hausdorff distance (stops below the zero threshold), the best rotations
+
+        index1 = index2 = None
+        if cKDTree is not None:
+            index1 = self.buildSpatialIndex(array1)
+            index2 = self.buildSpatialIndex(array2)
+        batches = rotations
+        if isinstance(rotations, np.ndarray):
+            batches = (rotations[start:start+batchsize] for start in range(0, len(rotations), batchsize))
+        buffer = self._rotationBuffer(array1, array2, batchsize)
+        best = (np.empty(0), np.empty((0, 3, 3)))
+        for batch in batches:
+            distances = self.calculateBatchHausdorffDistance(array1, array2, batch, index1, index2, buffer)
+            best = self._keepBest(best, distances, batch, keep)
+            if best[0][0] < 0.0000001:
+                break
+        return float(best[0][0]), best[1]
+
+    # merge newly scored rotations into the list of the best ones
+    def _keepBest(self, best, distances, rotations, keep):
+
+        # input: (distances, rotations) of the best so far, sorted, the new distances and rotations,
+        #        how many to keep
+        # ouput: (distances, rotations) of the keep best of both, sorted
+
+        distances = np.concatenate((best[0], distances))
+        rotations = np.concatenate((best[1], rotations))
+        order = np.argsort(distances)[:keep]
+        return distances[order], rotations[order]
+
+    # improve a rotation of array1 locally: ICP, then a pattern search on the hausdorff distance
+    def refineRotation(self, array1, array2, rotation, step=1, iterations=30, minstep=0.001):
+
+        # input: array for the two point cloud (centered, rotations turn around the origin), 3x3 rotation to
+        #        start from, first step (degrees) of the pattern search, number of ICP iterations,
+        #        step (degrees) at which the pattern search stops
+        # ouput: smallest hausdorff distance found, its 3x3 rotation
+
+        cloud1 = np.asarray(self.asPointCloud(array1), dtype=np.float64)
+        cloud2 = np.asarray(self.asPointCloud(array2), dtype=np.float64)
+        index1 = index2 = None
+        if cKDTree is not None:
+            index1 = self.buildSpatialIndex(cloud1)
+            index2 = self.buildSpatialIndex(cloud2)
+
+        # the pattern search scores 6 turns at once
+        buffer = self._rotationBuffer(cloud1, cloud2, 6)
+        rotation = np.asarray(rotation, dtype=np.float64)
+        best = float(self.calculateBatchHausdorffDistance(cloud1, cloud2, rotation[None], index1, index2,
+                                                          buffer)[0])
+        bestrotation = rotation
+
+        # ICP: match every rotated point to its nearest neighbour, then take the rotation fitting
+        # those matches best in the least squares sense (Kabsch)
+        current = rotation
+        for i in range(iterations if index2 is not None else 0):
+            matches = cloud2[index2.query(cloud1.dot(current.T))[1]]
+            u, singular, vt = np.linalg.svd(cloud1.T.dot(matches))
+            sign = np.sign(np.linalg.det(vt.T.dot(u.T)))
+            fitted = vt.T.dot(np.diag([1, 1, sign])).dot(u.T)
+            distance = float(self.calculateBatchHausdorffDistance(cloud1, cloud2, fitted[None], index1, index2,
+                                                                  buffer)[0])
+            if distance < best:
+                best, bestrotation = distance, fitted
+            if np.abs(fitted - current).max() < 1e-12:
+                break
+            current = fitted
+
+        # ICP minimizes the mean squared distance, not the largest one: try small turns around each axis
+        # of the best rotation, move while one of them helps, halve the turn when none does
+        axes = np.concatenate((np.eye(3), -np.eye(3)))
+        step = math.radians(step)
+        while step >= math.radians(minstep) and best >= 0.0000001:
+            candidates = np.matmul(self._rotationMatricesFromVectors(axes * step), bestrotation)
+            distances = self.calculateBatchHausdorffDistance(cloud1, cloud2, candidates, index1, index2, buffer)
+            if distances.min() < best:
+                best, bestrotation = float(distances.min()), candidates[np.argmin(distances)]
+            else:
+                step /= 2
+        return best, bestrotation
+
+    # coarse to fine rotation search that skips the cells of rotations which cannot beat the best one
+    def searchRotationsBranchAndBound(self, array1, array2, resolution=1, seeds=None, batchsize=256):
+
+        # input: array for the two point cloud (centered, rotations turn around the origin), the cell size
+        #        (degrees) at which refining stops, seeds: rotation matrices scored first (besides the
+        #        identity), e.g. from an alignment, so their distance prunes from the start,
+        #        number of cells scored at once
+        # ouput: smallest hausdorff distance found, its 3x3 rotation, number of rotations evaluated,
+        #        number of evaluations pruned (those a full refinement of the pruned cells would have made)
+
+        cloud1 = self.asPointCloud(array1)
+        cloud2 = self.asPointCloud(array2)
+        index1 = index2 = None
+        if cKDTree is not None:
+            index1 = self.buildSpatialIndex(cloud1)
+            index2 = self.buildSpatialIndex(cloud2)
+        buffer = self._rotationBuffer(cloud1, cloud2, batchsize)
+
+        # a rotation moves a point p by at most 2 |p| sin(angle / 2), so the distance of every rotation
+        # within angle t of R is at least the distance of R minus 2 radius sin(t / 2)
+        radius = math.sqrt(float((np.asarray(cloud1, dtype=np.float64)**2).sum(axis=1).max()))
+
+        # the identity is a cell corner, never a center, so it is always scored with the seeds
+        seeds = np.eye(3)[None] if seeds is None else np.concatenate((np.eye(3)[None],
+                                                                       np.reshape(seeds, (-1, 3, 3))))
+        distances = self.calculateBatchHausdorffDistance(cloud1, cloud2, seeds, index1, index2, buffer)
+        evaluated = len(seeds)
+        pruned = 0
+        best, bestrotation = float(distances.min()), seeds[np.argmin(distances)]
+
+        # cells are cubes of rotation vectors (axis * angle) in [-pi, pi]^3; every rotation of a cell of
+        # half width h is within angle sqrt(3) h of the rotation at its center (Hartley & Kahl 2009)
+        half = math.pi / 4
+        grid = -math.pi + half * (2 * np.arange(4) + 1)
+        centers = np.array(np.meshgrid(grid, grid, grid, indexing="ij")).reshape(3, -1).T
+        centers = centers[np.sqrt((centers**2).sum(axis=1)) - math.sqrt(3) * half <= math.pi]
+        levels = max(0, int(math.ceil(math.log(math.sqrt(3) * half / math.radians(resolution), 2))))
+        offsets = np.array([[i, j, k] for i in (-1, 1) for j in (-1, 1) for k in (-1, 1)]) * 0.5
+        # evaluations a full refinement of a cell of each level would make
+        subtree = [sum(8**i for i in range(1, levels - level + 1)) for level in range(levels + 1)]
+
+        # cells still to split, deepest first so the queue never holds more than about
+        # levels * batchsize cells, and among those of one level the lowest bound first
+        queue = []
+        counter = itertools.count()
+        pending = [(centers, np.zeros(len(centers), dtype=np.int64))]
+        while pending and best >= 0.0000001:
+            centers, depths = pending.pop()
+            for start in range(0, len(centers), batchsize):
+                part, partdepths = centers[start:start+batchsize], depths[start:start+batchsize]
+                rotations = self._rotationMatricesFromVectors(part)
+                distances = self.calculateBatchHausdorffDistance(cloud1, cloud2, rotations, index1, index2, buffer)
+                evaluated += len(part)
+                if len(distances) and distances.min() < best:
+                    best, bestrotation = float(distances.min()), rotations[np.argmin(distances)]
+                if best < 0.0000001:
+                    break
+                halves = (math.pi / 4) / 2.0**partdepths
+                bounds = distances - 2 * radius * np.sin(np.minimum(math.sqrt(3) * halves, math.pi) / 2)
+                for center, depth, bound in zip(part, partdepths.tolist(), bounds.tolist()):
+                    if depth == levels:
+                        continue
+                    if bound < best:
+                        heapq.heappush(queue, (-depth, bound, next(counter), center))
+                    else:
+                        pruned += subtree[depth]
+            if best < 0.0000001:
+                break
 
-        return ghdistance
+            # split the next cells in 8, dropping those that can no longer beat the best distance
+            parents = []
+            while queue and len(parents) * 8 < batchsize:
+                depth, bound, order, center = heapq.heappop(queue)
+                if bound < best:
+                    parents.append((center, -depth))
+                else:
+                    pruned += subtree[-depth]
+            if not parents:
+                break
+            centers = np.concatenate([center + offsets * ((math.pi / 4) / 2.0**depth) for center, depth in parents])
+            depths = np.repeat([depth + 1 for center, depth in parents], 8)
+            keep = np.sqrt((centers**2).sum(axis=1)) - math.sqrt(3) * (math.pi / 4) / 2.0**depths <= math.pi
+            pending.append((centers[keep], depths[keep]))
+        return best, bestrotation, evaluated, pruned
+
+    # rotation matrices of rotation vectors (the axis scaled by the angle in radians)
+    def _rotationMatricesFromVectors(self, vectors):
+
+        # input: (K, 3) rotation vectors
+        # output: (K, 3, 3) rotation matrices
+
+        vectors = np.asarray(vectors, dtype=np.float64).reshape(-1, 3)
+        angles = np.sqrt((vectors**2).sum(axis=1))
+        axes = vectors / np.where(angles > 0, angles, 1)[:, None]
+        x, y, z = axes[:, 0], axes[:, 1], axes[:, 2]
+        zero = np.zeros(len(vectors))
+        cross = np.stack([np.stack([zero, -z, y], axis=-1),
+                          np.stack([z, zero, -x], axis=-1),
+                          np.stack([-y, x, zero], axis=-1)], axis=1)
+        # Rodrigues: R = I + sin(a) K + (1 - cos(a)) K^2
+        return (np.eye(3) + np.sin(angles)[:, None, None] * cross
+                + (1 - np.cos(angles))[:, None, None] * np.matmul(cross, cross))
+
+    # rotations spread evenly over all rotations, none farther than about resolution from its nearest one
+    def sampleRotations(self, resolution):
+
+        # input: resolution, the angle (in degrees) of the largest rotation between any rotation and the
+        #        nearest sample (measured; it is never more than a few percent above this)
+        # output: (K, 3, 3) rotation matrices, the first one is the identity
+
+        return np.concatenate(list(self.iterSampleRotations(resolution, 1 << 16)))
+
+    # the rotations of sampleRotations a chunk at a time, so they never all have to be held
+    def iterSampleRotations(self, resolution, chunksize=64):
+
+        # input: resolution as in sampleRotations, number of rotations per chunk
+        # output: generator of (k, 3, 3) rotation matrices, k <= chunksize, the identity first
+
+        # a ball of rotations of radius d takes (d - sin d) / pi of the rotation group, so about
+        # pi / (d - sin d) samples are needed; even spirals need three times that to leave no gap over d
+        radian = math.radians(resolution)
+        n = int(math.ceil(3 * math.pi / (radian - math.sin(radian))))
+
+        yield np.eye(3)[None]
+        for start in range(0, n, chunksize):
+            yield self._spiralRotations(n, start, min(start + chunksize, n))
+
+    # rotations start to stop of the n point super-Fibonacci spiral of unit quaternions
+    def _spiralRotations(self, n, start, stop):
+
+        # input: number of points of the spiral, the range of them wanted
+        # output: (stop - start, 3, 3) rotation matrices
+
+        # super-Fibonacci spiral of unit quaternions (Alexa, CVPR 2022), close to uniform for any n
+        phi = math.sqrt(2)
+        psi = 1.533751168755204288118041
+        s = np.arange(start, stop) + 0.5
+        r = np.sqrt(s / n)
+        R = np.sqrt(1 - s / n)
+        alpha = 2 * math.pi * s / phi
+        beta = 2 * math.pi * s / psi
+        w, x, y, z = r * np.sin(alpha), r * np.cos(alpha), R * np.sin(beta), R * np.cos(beta)
+        return np.stack([np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis=-1),
+                         np.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis=-1),
+                         np.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=-1)], axis=1)
 
     # rotate each point of a point cloud array by its footstep
     # remember to move the point cloud to the origin before calling this function !!!
@@ -392,44 +1589,97 @@ class MyPointCloudUtil(object):
         # input: array for the two point cloud obtained from ptsloader1, footstep(angle) and direction('X','Y','Z')
         # ouput: the array after rotation
 
-        # using radians instead of angle
-        footstep = math.radians(footstep)
-
         # python use == to compare value, java use == to compare object
         if direction == 'X':
-            for coordinate in array:
-                tempx = coordinate[0]
-                tempy = coordinate[1]
-                tempz = coordinate[2]
-                coordinate[0] = tempx
-                coordinate[1] = math.cos(footstep)*tempy - math.sin(footstep)*tempz
-                coordinate[2] = math.sin(footstep)*tempy + math.cos(footstep)*tempz
+            matrix = self.rotationMatrixFromEuler(footstep, 0, 0)
         elif direction == 'Y':
-            for coordinate in array:
-                tempx = coordinate[0]
-                tempy = coordinate[1]
-                tempz = coordinate[2]
-                coordinate[0] = math.cos(footstep)*tempx + math.sin(footstep)*tempz
-                coordinate[1] = tempy
-                coordinate[2] = -math.sin(footstep)*tempx + math.cos(footstep)*tempz
+            matrix = self.rotationMatrixFromEuler(0, footstep, 0)
         elif direction == 'Z':
-            for coordinate in array:
-                tempx = coordinate[0]
-                tempy = coordinate[1]
-                tempz = coordinate[2]
-                coordinate[0] = math.cos(footstep)*tempx - math.sin(footstep)*tempy
-                coordinate[1] = math.sin(footstep)*tempx + math.cos(footstep)*tempy
-                coordinate[2] = tempz
+            matrix = self.rotationMatrixFromEuler(0, 0, footstep)
+        else:
+            return array
+
+        cloud = self.asPointCloud(array)
+        self.transform(cloud, matrix, out=cloud)
+        self._writeBack(array, cloud)
         return array # do not need to return, already change the list
 
+    # apply a 3x3 matrix (e.g. a rotation) to every point of a cloud with one matrix multiply
+    def transform(self, array, matrix, out=None):
+
+        # input: array for the point cloud obtained from ptsloader1, 3x3 matrix,
+        #        out: PointCloud of the same shape and dtype to write into (may be the cloud itself)
+        # output: the transformed PointCloud (out if given)
+
+        cloud = self.asPointCloud(array)
+        # each row is a point, so transforming all of them is cloud * matrix^T
+        matrixT = np.asarray(matrix, dtype=cloud.dtype).T
+        if out is None:
+            return self.asPointCloud(np.dot(cloud, matrixT))
+        if out is cloud:
+            # in place, the product needs a temporary
+            out[...] = np.dot(cloud, matrixT)
+        else:
+            np.dot(cloud, matrixT, out=out)
+        return out
+
+    # rotation matrix of Euler angles: first around X, then around Y, then around Z (R = Rz * Ry * Rx)
+    def rotationMatrixFromEuler(self, x, y, z, degrees=True):
+
+        # input: the three angles, in degrees unless degrees=False
+        # output: 3x3 rotation matrix
+
+        if degrees:
+            x, y, z = math.radians(x), math.radians(y), math.radians(z)
+        cx, sx = math.cos(x), math.sin(x)
+        cy, sy = math.cos(y), math.sin(y)
+        cz, sz = math.cos(z), math.sin(z)
+        return np.array([[cz*cy, cz*sy*sx - sz*cx, cz*sy*cx + sz*sx],
+                         [sz*cy, sz*sy*sx + cz*cx, sz*sy*cx - cz*sx],
+                         [-sy, cy*sx, cy*cx]])
+
+    # rotation matrix of a rotation around an axis through the origin (Rodrigues' formula)
+    def rotationMatrixFromAxisAngle(self, axis, angle, degrees=True):
+
+        # input: axis vector (any length but 0), angle, in degrees unless degrees=False
+        # output: 3x3 rotation matrix
+
+        axis = np.asarray(axis, dtype=np.float64)
+        x, y, z = axis / math.sqrt(axis.dot(axis))
+        if degrees:
+            angle = math.radians(angle)
+        c = math.cos(angle)
+        s = math.sin(angle)
+        return np.array([[x*x*(1-c) + c, x*y*(1-c) - z*s, x*z*(1-c) + y*s],
+                         [x*y*(1-c) + z*s, y*y*(1-c) + c, y*z*(1-c) - x*s],
+                         [x*z*(1-c) - y*s, y*z*(1-c) + x*s, z*z*(1-c) + c]])
+
+    # rotation matrix of a quaternion
+    def rotationMatrixFromQuaternion(self, quaternion):
+
+        # input: quaternion [w, x, y, z] (any length but 0)
+        # output: 3x3 rotation matrix
+
+        quaternion = np.asarray(quaternion, dtype=np.float64)
+        w, x, y, z = quaternion / math.sqrt(quaternion.dot(quaternion))
+        return np.array([[1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)],
+                         [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)],
+                         [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)]])
+
     # using GHDistance <= 1/2 max(diameter(x), diameter(y))
-    def calculateUpperBoundofGHDistance(self, array1, array2):
+    def calculateUpperBoundofGHDistance(self, array1, array2, epsilon=None):
 
-        # input: array for the two point cloud obtained from ptsloader1
+        # input: array for the two point cloud obtained from ptsloader1, relative error allowed in the
+        #        diameters (None for exact diameters, a number for a linear time but looser bound)
         # ouput: the upper bound of gromov-hausdorff distance
 
-        len1, max1, min1 = self.getProperties(array1)
-        len2, max2, min2 = self.getProperties(array2)
+        if epsilon is None:
+            max1 = self.calculateDiameter(array1)[0]
+            max2 = self.calculateDiameter(array2)[0]
+        else:
+            # the approximation is at most a factor 1-epsilon too small, scale up to stay an upper bound
+            max1 = self.calculateApproximateDiameter(array1, epsilon)[0] / (1 - epsilon)
+            max2 = self.calculateApproximateDiameter(array2, epsilon)[0] / (1 - epsilon)
         upperbound = max(max1, max2) / 2
 
         return upperbound
@@ -453,8 +1703,9 @@ class MyPointCloudUtil(object):
         # calculate the radian of the two direction
         radian = self.calculateRadianBetweenDirections(direction1, direction2)
 
-        # rotate the point cloud array
-        self.rotateAcrossNormalVector(normalvector,array2,radian)
+        # rotate the point cloud array, turning direction2 back onto direction1 (the angle is in degrees)
+        if radian > 0 and any(normalvector):
+            self.rotateAcrossNormalVector(normalvector,array2,-math.degrees(radian))
 
         # calculate hausdorrf distance at this position
         distance = self.calculateHausdorffDistance(array1, array2)
@@ -462,84 +1713,399 @@ class MyPointCloudUtil(object):
         # use this as the upper bound
         return distance
 
-    def multiThreadCompute(self, threadsnum):
-        pass
+    # using overlap principal axes way
+    def calculatePCAUpperBound(self, array1, array2):
+
+        # input: array for the two point cloud obtained from ptsloader1
+        # ouput: the smallest hausdorff distance over the 24 rotations putting the principal axes of array1
+        #        on those of array2 (an upper bound of the gromov-hausdorff distance), that 3x3 rotation of array1
+
+        # first, move to origin
+        self.overlapCenterOfGravity(array1,array2)
+        cloud1 = self.asPointCloud(array1)
+        cloud2 = self.asPointCloud(array2)
+
+        # principal axes: eigenvectors (columns) of the 3x3 covariance matrix
+        axes1 = np.linalg.eigh(np.cov(np.asarray(cloud1, dtype=np.float64).T))[1]
+        axes2 = np.linalg.eigh(np.cov(np.asarray(cloud2, dtype=np.float64).T))[1]
+
+        # the axes have no sign and close eigenvalues can swap them, so try every signed permutation
+        # of the axes that gives a rotation (not a reflection)
+        rotations = []
+        for permutation in itertools.permutations(range(3)):
+            for signs in itertools.product((1, -1), repeat=3):
+                matching = np.zeros((3, 3))
+                matching[list(permutation), range(3)] = signs
+                rotation = axes2.dot(matching).dot(axes1.T)
+                if np.linalg.det(rotation) > 0:
+                    rotations.append(rotation)
+
+        distances = self.calculateBatchHausdorffDistance(cloud1, cloud2, rotations)
+        best = int(np.argmin(distances))
+        return float(distances[best]), rotations[best]
+
+    # bracket the gromov-hausdorff distance of the two clouds as metric spaces (only their own point distances count)
+    def calculateGromovHausdorffInterval(self, array1, array2, tolerance=0.0, maxpoints=1 << 22, voxelsize=None,
+                                         samples=None):
+
+        # input: array for the two point cloud obtained from ptsloader1, stop as soon as upper - lower <= tolerance,
+        #        maxpoints: number of point distances held in memory at once,
+        #        voxelsize / samples: bracket the voxelDownsample / farthestPointSampling of both clouds instead
+        #        (the inputs are then not moved)
+        # output: lower, upper with lower <= d_GH <= upper, d_GH being half the smallest distortion
+        #         max |d(x,x') - d(y,y')| over all correspondences between the two clouds; with voxelsize or
+        #         samples the interval is widened by the reduction error so it still holds at full resolution
+
+        if voxelsize is not None or samples is not None:
+            array1, array2, error = self._reduceClouds(array1, array2, voxelsize, samples)
+            lower, upper = self.calculateGromovHausdorffInterval(array1, array2, tolerance, maxpoints)
+            return max(0.0, lower - error), upper + error
+
+        # move to origin, this does not change any distance inside a cloud
+        self.overlapCenterOfGravity(array1,array2)
+        cloud1 = self.asPointCloud(array1)
+        cloud2 = self.asPointCloud(array2)
+        tilesize = max(1, int(math.sqrt(maxpoints)))
+
+        # the diameters: d_GH >= |diam1 - diam2| / 2 and, matching everything with one point, d_GH <= max / 2
+        diameter1 = self.calculateDiameter(cloud1)[0]
+        diameter2 = self.calculateDiameter(cloud2)[0]
+        lower = abs(diameter1 - diameter2) / 2
+        upper = max(diameter1, diameter2) / 2
+        if upper - lower <= tolerance:
+            return lower, max(lower, upper)
+
+        # any rigid placement bounds d_GH by the hausdorff distance, start from the principal axes one
+        aligned, rotation = self.calculatePCAUpperBound(cloud1, cloud2)
+        upper = min(upper, aligned)
+        if upper - lower <= tolerance:
+            return lower, max(lower, upper)
+
+        # a correspondence moves the eccentricity max_x' d(x,x') of every point by at most its distortion
+        eccentricity1 = self.calculatePairwiseDistances(cloud1, cloud1, "rowmax", tilesize)[0]
+        eccentricity2 = self.calculatePairwiseDistances(cloud2, cloud2, "rowmax", tilesize)[0]
+        lower = max(lower, self._valueSetHausdorff(eccentricity1, eccentricity2) / 2)
+        if upper - lower <= tolerance:
+            return lower, max(lower, upper)
+
+        # the same holds for the set of all point distances, when it fits in memory
+        if len(cloud1)*(len(cloud1)-1)//2 <= maxpoints and len(cloud2)*(len(cloud2)-1)//2 <= maxpoints:
+            # a correspondence can match two points with one, so d(x,x) = 0 belongs to both sets
+            lower = max(lower, self._valueSetHausdorff(np.append(self._pointDistances(cloud1, tilesize), 0.0),
+                                                       np.append(self._pointDistances(cloud2, tilesize), 0.0)) / 2)
+            if upper - lower <= tolerance:
+                return lower, max(lower, upper)
+
+        # match every point with its nearest neighbour in the other aligned cloud and measure the distortion
+        moved = self.transform(cloud1, rotation)
+        points1 = np.concatenate((np.arange(len(cloud1)), self._nearestIndices(cloud2, moved, tilesize)))
+        points2 = np.concatenate((self._nearestIndices(moved, cloud2, tilesize), np.arange(len(cloud2))))
+        pairs = np.unique(np.stack((points1, points2), axis=1), axis=0)
+        distortion = self._correspondenceDistortion(cloud1[pairs[:, 0]], cloud2[pairs[:, 1]],
+                                                    2 * upper, tilesize)
+        upper = min(upper, distortion / 2)
+        return lower, max(lower, upper)
+
+    # all the distances d(x,x') with x before x', sorted
+    def _pointDistances(self, cloud, tilesize):
+        values = []
+        for start1, start2, squared in self._distanceTiles(cloud, cloud, tilesize, triangle=True):
+            rows, columns = np.triu_indices(len(squared), start1 - start2 + 1, squared.shape[1])
+            values.append(np.sqrt(squared[rows, columns]))
+        values = np.concatenate(values) if values else np.empty(0)
+        values.sort()
+        return values
+
+    # index of the nearest point of cloud2 for every point of cloud1
+    def _nearestIndices(self, cloud1, cloud2, tilesize):
+        if cKDTree is not None:
+            return self.buildSpatialIndex(cloud2).query(np.asarray(cloud1))[1]
+        return self.calculatePairwiseDistances(cloud1, cloud2, "rowmin", tilesize)[1]
+
+    # max |d(x_i,x_j) - d(y_i,y_j)| over the pairs of matched points x_i <-> y_i,
+    # giving up once it reaches stop
+    def _correspondenceDistortion(self, points1, points2, stop, tilesize):
+        distortion = 0.0
+        tiles = zip(self._distanceTiles(points1, points1, tilesize, triangle=True),
+                    self._distanceTiles(points2, points2, tilesize, triangle=True))
+        for (start1, start2, squared1), (start1, start2, squared2) in tiles:
+            distortion = max(distortion, float(np.abs(np.sqrt(squared1) - np.sqrt(squared2)).max()))
+            if distortion >= stop:
+                break
+        return distortion
+
+    # hausdorff distance between two sets of numbers
+    def _valueSetHausdorff(self, values1, values2):
+        values1 = np.sort(values1)
+        values2 = np.sort(values2)
+        return max(self._directedValueSetHausdorff(values1, values2),
+                   self._directedValueSetHausdorff(values2, values1))
+
+    def _directedValueSetHausdorff(self, values1, values2):
+        # the nearest value of the sorted values2 is one of the two around the insertion point
+        after = np.minimum(np.searchsorted(values2, values1), len(values2) - 1)
+        before = np.maximum(after - 1, 0)
+        gaps = np.minimum(np.abs(values1 - values2[after]), np.abs(values1 - values2[before]))
+        return float(gaps.max()) if len(gaps) else 0.0
+
+    # compare every cloud of a directory with every other one
+    def calculateDistanceMatrix(self, path, metric="hausdorff", workers=None, threshold=None, output=None,
+                                footstep=10):
+
+        # input: the dictory contains all point cloud file, metric: "hausdorff" (as the clouds are), "aligned"
+        #        (calculateGromovHausdorffDistance with the uniform sampler, footstep and principal axes seeding)
+        #        or "gh" (calculateGromovHausdorffInterval), number of worker processes (None: one per cpu,
+        #        1: compare in this process), pairs proven farther apart than threshold are not compared,
+        #        output: csv file path a line "name1,name2,distance" (gh: "name1,name2,lower,upper") is
+        #        appended to as each pair finishes
+        # output: sorted file names, symmetric matrix of the distances (gh: N x N x 2 of lower, upper),
+        #         inf for the skipped pairs
+
+        if metric not in ("hausdorff", "aligned", "gh"):
+            raise ValueError("unknown distance metric %r" % (metric,))
+        clouds = self.batchloader(path, workers)
+        names = sorted(clouds)
+        clouds = [clouds[name] for name in names]
+        width = 2 if metric == "gh" else 1
+        matrix = np.zeros((len(names), len(names), width))
+
+        # cheap lower bounds first: the bounding boxes for hausdorff, half the diameter difference otherwise
+        pairs = [(i, j) for i in range(len(names)) for j in range(i+1, len(names))]
+        skipped = []
+        if threshold is not None:
+            if metric == "hausdorff":
+                boxes = [np.array(self.calculateBoundingBox([cloud]), dtype=np.float64) for cloud in clouds]
+                lowerbounds = [np.abs(boxes[i] - boxes[j]).max() for i, j in pairs]
+            else:
+                diameters = [self.calculateDiameter(cloud)[0] for cloud in clouds]
+                lowerbounds = [abs(diameters[i] - diameters[j]) / 2 for i, j in pairs]
+            skipped = [pair for pair, bound in zip(pairs, lowerbounds) if bound > threshold]
+            pairs = [pair for pair, bound in zip(pairs, lowerbounds) if bound <= threshold]
+
+        csvfile = open(output, "a", newline="") if output is not None else None
+        # quotes file names holding commas or quotes
+        writer = csv.writer(csvfile) if csvfile is not None else None
+        try:
+            results = [(i, j, (float('inf'),) * width) for i, j in skipped]
+            if workers == 1 or len(pairs) <= 1:
+                _initMatrixWorker(self, clouds, metric, footstep)
+                results = itertools.chain(results, map(_matrixWorker, pairs))
+                pool = None
+            else:
+                pool = multiprocessing.Pool(workers, _initMatrixWorker, (self, clouds, metric, footstep))
+                results = itertools.chain(results, pool.imap_unordered(_matrixWorker, pairs))
+            try:
+                for i, j, distance in results:
+                    matrix[i, j] = matrix[j, i] = distance
+                    if csvfile is not None:
+                        writer.writerow([names[i], names[j]] + [repr(float(d)) for d in distance])
+                        csvfile.flush()
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                _matrixWorkerState.clear()
+        finally:
+            if csvfile is not None:
+                csvfile.close()
+
+        if width == 1:
+            matrix = matrix[:, :, 0]
+        return names, matrix
+
+    # the distance calculateDistanceMatrix puts in the matrix for one pair
+    def _calculatePairDistance(self, metric, array1, array2, footstep):
+
+        # input: metric as in calculateDistanceMatrix, the two clouds (they may be moved), footstep(angle)
+        # output: tuple of the distance (gh: lower, upper)
+
+        if metric == "hausdorff":
+            return (self.calculateHausdorffDistance(array1, array2),)
+        if metric == "aligned":
+            return (self.calculateGromovHausdorffDistance(footstep, array1, array2, "uniform", 1, True),)
+        return self.calculateGromovHausdorffInterval(array1, array2)
+
+    # calculateGromovHausdorffDistance with the rotation grid split over a pool of processes
+    def multiThreadCompute(self, threadsnum, footstep, array1, array2):
+
+        # input: number of worker processes, footstep(angle) for each rotation,
+        #        array for the two point cloud obtained from ptsloader1
+        # ouput: the discrete gromov-hausdorff distance, the (x, y, z) Euler angles of the best rotation
+
+        # overlap their center of gravity
+        self.overlapCenterOfGravity(array1,array2)
+        array1 = self.asPointCloud(array1)
+        array2 = self.asPointCloud(array2)
+
+        if threadsnum == 1:
+            ghdistance, angles = self.subThreadForGHDistance(footstep, range(0,360,footstep), array1, array2)
+            if ghdistance < 0.0000001:
+                return 0, angles
+            return ghdistance, angles
+
+        # one task per X angle; the clouds reach each worker once, through the pool initializer
+        tasks = [[x] for x in range(0,360,footstep)]
+
+        stop = multiprocessing.Event()
+        pool = multiprocessing.Pool(threadsnum, _initGHWorker, (self, footstep, array1, array2, stop))
+        ghdistance, angles = float('inf'), (0, 0, 0)
+        try:
+            for distance, best in pool.imap_unordered(_ghWorker, tasks):
+                if distance < ghdistance:
+                    ghdistance, angles = distance, best
+                # if totally the same, the other workers can stop
+                if ghdistance < 0.0000001:
+                    stop.set()
+                    return 0, angles
+        finally:
+            pool.terminate()
+        return ghdistance, angles
+
+    # the work of one worker of multiThreadCompute: the rotations with the given X angles
+    def subThreadForGHDistance(self, footstep, xangles, array1, array2, index1=None, index2=None, stop=None):
+
+        # input: footstep(angle) for each rotation, the X angles to search, array for the two point cloud
+        #        (centered), buildSpatialIndex of both if already built, multiprocessing.Event telling the
+        #        search to give up because another worker already found a match
+        # ouput: the smallest hausdorff distance found, the (x, y, z) Euler angles it was found at
 
-    def subThreadForGHDistance(self,):
-        pass
+        ghdistance, rotations, angles = self._searchEulerGrid(footstep, array1, array2, 1, xangles,
+                                                              index1, index2, stop)
+        return ghdistance, (angles[0] if angles else (0, 0, 0))
+
+# batchloader task, at module level so worker processes can unpickle it
+def _loadWorker(task):
+
+    # input: (MyPointCloudUtil instance, file path, file name)
+    # output: (file name, PointCloud), or the path of its cache file when there is a cache, so the
+    #         parent maps it instead of receiving a copy
+
+    util, path, name = task
+    cloud = util.load(path)
+    if util.cachedir:
+        return name, util._cachePath(path)
+    return name, cloud
+
+# state of a multiThreadCompute worker process, set once by _initGHWorker
+_ghWorkerState = {}
+
+# multiThreadCompute pool initializer, the clouds are sent once per process instead of once per task
+def _initGHWorker(util, footstep, array1, array2, stop):
+
+    # input: MyPointCloudUtil instance, footstep(angle), the two centered clouds, the shared stop event
+    # output: none, _ghWorkerState is filled and the k-d trees are built
+
+    _ghWorkerState.update(util=util, footstep=footstep, array1=array1, array2=array2, stop=stop)
+    if cKDTree is not None:
+        _ghWorkerState.update(index1=util.buildSpatialIndex(array1), index2=util.buildSpatialIndex(array2))
+
+# multiThreadCompute task
+def _ghWorker(xangles):
+
+    # input: the X angles to search
+    # output: (smallest hausdorff distance, (x, y, z) Euler angles)
+
+    state = _ghWorkerState
+    return state["util"].subThreadForGHDistance(state["footstep"], xangles, state["array1"], state["array2"],
+                                                state.get("index1"), state.get("index2"), state["stop"])
+
+# state of a calculateDistanceMatrix worker process, set once by _initMatrixWorker
+_matrixWorkerState = {}
+
+# calculateDistanceMatrix pool initializer, the clouds are sent once per process instead of once per pair
+def _initMatrixWorker(util, clouds, metric, footstep):
+
+    # input: MyPointCloudUtil instance, list of the clouds, metric name, footstep(angle)
+    # output: none, _matrixWorkerState is filled
+
+    _matrixWorkerState.update(util=util, clouds=clouds, metric=metric, footstep=footstep)
+
+# calculateDistanceMatrix task
+def _matrixWorker(pair):
+
+    # input: (i, j) indices of the two clouds
+    # output: (i, j, tuple of the distance)
+
+    i, j = pair
+    state = _matrixWorkerState
+    # the distance functions may center the clouds, which would move them for the next pairs
+    array1 = np.array(state["clouds"][i])
+    array2 = np.array(state["clouds"][j])
+    return i, j, tuple(state["util"]._calculatePairDistance(state["metric"], array1, array2, state["footstep"]))
 
 # ======================= testing =========================
 
-instance = MyPointCloudUtil()
+if __name__ == "__main__":
+
+    instance = MyPointCloudUtil()
 
-array1 = instance.ptsloader1("test1.pts")
-print(array1)
-array2 = instance.ptsloader1("test2.pts")
-print(array2)
-instance.overlapCenterOfGravity(array1,array2)
-print (array1)
-print(array2)
-instance.rotate(180,array1,'X')
-print(array1)
-print(instance.calculateGromovHausdorffDistance(1,array1,array2))
-print(instance.calculateIntuitiveUpperBound(array1,array2))
+    array1 = instance.ptsloader1("test1.pts")
+    print(array1)
+    array2 = instance.ptsloader1("test2.pts")
+    print(array2)
+    instance.overlapCenterOfGravity(array1,array2)
+    print (array1)
+    print(array2)
+    instance.rotate(180,array1,'X')
+    print(array1)
+    print(instance.calculateGromovHausdorffDistance(1,array1,array2))
+    print(instance.calculateIntuitiveUpperBound(array1,array2))
 
-# print(instance.calculateDiameterDirection(array2))
+    # print(instance.calculateDiameterDirection(array2))
 
-# X,Y,Z = instance.calculateCenter(array1)
-# print(X,Y,Z)
-#
-# X2, Y2, Z2 = instance.calculateCenter(array2)
-# print(X2,Y2,Z2)
-#
-# instance.overlapCenterOfGravity(array1,array2)
-# print (array2)
-#
-# dis = instance.calculateGromovHausdorffDistance(1,array1,array2)
-# print(dis)
+    # X,Y,Z = instance.calculateCenter(array1)
+    # print(X,Y,Z)
+    #
+    # X2, Y2, Z2 = instance.calculateCenter(array2)
+    # print(X2,Y2,Z2)
+    #
+    # instance.overlapCenterOfGravity(array1,array2)
+    # print (array2)
+    #
+    # dis = instance.calculateGromovHausdorffDistance(1,array1,array2)
+    # print(dis)
 
-# instance.rotate(1,array1,'X')
-# array1 = instance.rotate(1,array1,'X')
-#print(array1)
+    # instance.rotate(1,array1,'X')
+    # array1 = instance.rotate(1,array1,'X')
+    #print(array1)
 
 
 
-# import plyfile
-# plydata = plyfile.PlyData.read('texturedknot.ply')
-# print(plydata)
-# print(plydata["vertex"][0])
+    # import plyfile
+    # plydata = plyfile.PlyData.read('texturedknot.ply')
+    # print(plydata)
+    # print(plydata["vertex"][0])
 
-# reload(sys)
-# sys.setdefaultencoding('utf8')
+    # reload(sys)
+    # sys.setdefaultencoding('utf8')
 
-#print(instance.plyloader("airplane.ply"))
+    #print(instance.plyloader("airplane.ply"))
 
-# array = instance.offloader("m101.off")
-# print(len(array))
-#print(instance.offloader("000.off"))
-#print(instance.plyloader("tr_scan_000.ply"))
+    # array = instance.offloader("m101.off")
+    # print(len(array))
+    #print(instance.offloader("000.off"))
+    #print(instance.plyloader("tr_scan_000.ply"))
 
-#print(instance.plyloader("texturedknot.ply"))
+    #print(instance.plyloader("texturedknot.ply"))
 
-# about ??? hours using i7-6920HQ processor
-# starttime = datetime.datetime.now()
-# print(instance.calculateGromovHausdorffDistance(1,instance.ptsloader1("test1.pts"),instance.ptsloader1("000020.pts")))
-# endtime = datetime.datetime.now()
-# print (endtime - starttime)
+    # about ??? hours using i7-6920HQ processor
+    # starttime = datetime.datetime.now()
+    # print(instance.calculateGromovHausdorffDistance(1,instance.ptsloader1("test1.pts"),instance.ptsloader1("000020.pts")))
+    # endtime = datetime.datetime.now()
+    # print (endtime - starttime)
 
-# len,max,min = instance.getProperties(instance.ptsloader1("test1.pts"))
-# print(len,max,min)
+    # len,max,min = instance.getProperties(instance.ptsloader1("test1.pts"))
+    # print(len,max,min)
 
 
-# X, Y, Z = instance.extractXYZ(instance.myload("test1.pts"))
-# print(X)
-# print(Y)
-# print(Z)
+    # X, Y, Z = instance.extractXYZ(instance.myload("test1.pts"))
+    # print(X)
+    # print(Y)
+    # print(Z)
 
 
-#print(instance.myload("test1.pts"))
-#print(instance.myload("000020.pts"))
+    #print(instance.myload("test1.pts"))
+    #print(instance.myload("000020.pts"))
 
 
-# instance.myplot("test1.pts")
-# instance.myplot("000020.pts")
\ No newline at end of file
+    # instance.myplot("test1.pts")
+    # instance.myplot("000020.pts")
\ No newline at end of file